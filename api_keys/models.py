@@ -1,8 +1,13 @@
+from collections import OrderedDict
 import string
 import random
+import threading
+import time
 
+from django.core.cache import cache
 from django.db import models
 from django.dispatch import receiver
+from django.utils.crypto import get_random_string
 from django.conf import settings
 
 from account.signals import user_signed_up
@@ -28,6 +33,7 @@ class APIKey(models.Model):
         super(APIKey, self).save(*args, **kwargs)
 
         self.save_key_to_redis()
+        user_keys.forget(self.user_id)
 
     @property
     def redis_key(self):
@@ -48,14 +54,76 @@ class APIKey(models.Model):
 
     def delete_key_from_redis(self):
         r = redis_connection()
-        r.delete(self.redis_key)
-        r.delete(self.redis_key_quota)
+        r.delete(self.redis_key, self.redis_key_quota)
 
     @staticmethod
     def generate_key(size=40, chars=string.ascii_letters + string.digits):
         return ''.join(random.choice(chars) for x in range(size))
 
 
+class UserKeyCache(object):
+    """Remembers each user's API key (or that they have none), for the
+    add_api_key middleware: a small in-process LRU in front of the shared
+    Django cache, in front of the database. Saving or deleting a key clears
+    it from the shared cache, but only from this process's LRU, so entries
+    there are only trusted for local_seconds.
+
+    Clearing is done by changing the user's version in the shared cache,
+    and entries there are only used if stored under the current version,
+    so that a request that read the database before a key was saved or
+    deleted can't store what it read over the top for everyone."""
+    local_size = 10000
+    local_seconds = 60
+
+    def __init__(self):
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cache_key(self, user_id):
+        return 'api_key:user:{0}'.format(user_id)
+
+    def version_key(self, user_id):
+        return 'api_key:user:{0}:version'.format(user_id)
+
+    def get(self, user_id):
+        """Returns the user's API key string, or None"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.local.get(user_id)
+            if entry and entry[1] > now:
+                self.local.move_to_end(user_id)
+                return entry[0] or None
+
+        # Entries are (version, key), where an empty key means the user has none
+        cached = cache.get_many([self.cache_key(user_id), self.version_key(user_id)])
+        version = cached.get(self.version_key(user_id))
+        entry = cached.get(self.cache_key(user_id))
+        if entry and entry[0] == version:
+            key = entry[1]
+        else:
+            key = self.fetch(user_id)
+            cache.set(self.cache_key(user_id), (version, key))
+
+        with self.lock:
+            self.local[user_id] = (key, now + self.local_seconds)
+            self.local.move_to_end(user_id)
+            if len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+        return key or None
+
+    def fetch(self, user_id):
+        api_key = APIKey.objects.filter(user_id=user_id).first()
+        return api_key.key if api_key else ''
+
+    def forget(self, user_id):
+        cache.set(self.version_key(user_id), get_random_string(12))
+        with self.lock:
+            self.local.pop(user_id, None)
+
+
+user_keys = UserKeyCache()
+
+
 @receiver(user_signed_up)
 def create_key_for_new_user(user, form, **kwargs):
     """Create a new APIKey for a user who just signed up."""
@@ -76,3 +144,4 @@ def delete_api_key_from_redis(sender, instance, using, **kwargs):
     """Delete an APIKey from redis when it's deleted."""
     if sender == APIKey:
         instance.delete_key_from_redis()
+        user_keys.forget(instance.user_id)
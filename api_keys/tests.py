@@ -1,7 +1,9 @@
 from io import StringIO
 
+import lupa
 from mock import patch
 from mockredis import mock_strict_redis_client
+from mockredis.client import MockRedis
 
 from django.test import TestCase
 from django.test.utils import override_settings
@@ -11,16 +13,43 @@ from django.core.management import call_command
 
 from account.signals import user_signed_up
 
-from .models import APIKey, create_key_for_new_user
+from .models import APIKey, create_key_for_new_user, user_keys
 from .utils import redis_connection, RedisStrings
 
 
+class LuaScript(object):
+    """
+    Stands in for a registered script on the mock Redis, running it with lupa,
+    as mockredis's own scripting needs lunatic-python under Python 2.
+    """
+
+    def __init__(self, client, script):
+        self.client = client
+        self.script = script
+
+    def __call__(self, keys=[], args=[], client=None):
+        client = client or self.client
+        lua = lupa.LuaRuntime()
+        lua.globals().KEYS = lua.table(*keys)
+        lua.globals().ARGV = lua.table(*[str(arg) for arg in args])
+        lua.globals().redis = lua.table(call=lambda *call_args: self.reply(client.call(*call_args)))
+        return lua.execute(self.script)
+
+    @staticmethod
+    def reply(value):
+        # As in Redis, a nil reply is false in Lua
+        return False if value is None else value
+
+
 class PatchedRedisTestCase(TestCase):
     """
     Helper TestCase subclass that patches the redis library.
     """
 
     def setUp(self):
+        self.script_patcher = patch.object(
+            MockRedis, 'register_script', lambda client, script: LuaScript(client, script))
+        self.script_patcher.start()
         self.redis_patcher = patch(
             'api_keys.utils.redis.StrictRedis',
             mock_strict_redis_client
@@ -33,6 +62,7 @@ class PatchedRedisTestCase(TestCase):
         self.sentinel_patcher.start()
 
     def tearDown(self):
+        self.script_patcher.stop()
         self.redis_patcher.stop()
         self.sentinel_patcher.stop()
 
@@ -238,6 +268,34 @@ class APIKeyModelTest(PatchedRedisTestCase):
             APIKey.objects.get(pk=key.pk)
         self.assertIsNone(r.get(expected_key))
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_user_keys_cache(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(user_keys.get(self.user.id))
+            self.assertIsNone(user_keys.get(self.user.id))
+        key = APIKey.objects.create(user=self.user, key="test_key")
+        with self.assertNumQueries(1):
+            self.assertEqual(user_keys.get(self.user.id), "test_key")
+        # Another process, with nothing in its own LRU, uses the shared cache
+        user_keys.local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(user_keys.get(self.user.id), "test_key")
+        key.delete()
+        self.assertIsNone(user_keys.get(self.user.id))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_user_keys_cache_race(self):
+        def fetch_then_save(user_id):
+            # A key is saved after the database has been read
+            APIKey.objects.create(user=self.user, key="test_key")
+            return ''
+
+        with patch.object(user_keys, 'fetch', side_effect=fetch_then_save):
+            self.assertIsNone(user_keys.get(self.user.id))
+        # What was read before the save isn't used by anyone else
+        user_keys.local.clear()
+        self.assertEqual(user_keys.get(self.user.id), "test_key")
+
 
 class RestrictAPICommandTest(PatchedRedisTestCase):
 
@@ -34,6 +34,14 @@ def redis_connection():
     return _connection
 
 
+def redis_pipeline(transaction=False):
+    """Returns a pipeline on the shared connection. Commands queued on it are
+    sent together in one round trip when execute() is called, which returns
+    their results in order. With transaction=True they're wrapped in
+    MULTI/EXEC, so nothing else can run in between them."""
+    return redis_connection().pipeline(transaction=transaction)
+
+
 class RedisStrings(object):
     API_RESTRICT = 'api:{0}:restricted'.format(settings.REDIS_API_NAME)
     API_THROTTLE = 'api:{0}:throttled'.format(settings.REDIS_API_NAME)
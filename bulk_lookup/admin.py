@@ -1,6 +1,41 @@
 from django.contrib import admin
+from django.utils.html import format_html, format_html_join
+
 from .models import BulkLookup, OutputOption
 
 
-admin.site.register(BulkLookup)
+class BulkLookupAdmin(admin.ModelAdmin):
+    list_display = ('email', 'created', 'started', 'finished', 'error_count', 'rows', 'duration')
+    search_fields = ('email',)
+    readonly_fields = ('stats_table',)
+
+    def save_model(self, request, obj, form, change):
+        # Without a profile, the job would count as having no rows and so
+        # be processed ahead of everything else
+        if not obj.profile and obj.original_file:
+            obj.profile = obj.make_profile()
+        super().save_model(request, obj, form, change)
+
+    def rows(self, obj):
+        return obj.stats['rows'] if obj.stats else None
+
+    def duration(self, obj):
+        if obj.started and obj.finished:
+            return obj.finished - obj.started
+
+    @admin.display(description='Stats')
+    def stats_table(self, obj):
+        if not obj.stats:
+            return ''
+        return format_html(
+            '<table><tr><th>Stage</th><th>Seconds</th><th>Queries</th><th>Rows</th></tr>{}</table>'
+            '<p>{} postcode cache hits, {} misses; peak memory during the job {} kB; {}</p>',
+            format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>', (
+                (name, stage['seconds'], stage['queries'], stage['rows'])
+                for name, stage in obj.stats['stages'].items())),
+            obj.stats['cache_hits'], obj.stats['cache_misses'], obj.stats['peak_memory_kb'],
+            obj.stats['outcome'])
+
+
+admin.site.register(BulkLookup, BulkLookupAdmin)
 admin.site.register(OutputOption)
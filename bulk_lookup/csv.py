@@ -1,5 +1,14 @@
+import codecs
+import csv
+from datetime import datetime, timedelta
+import io
 import os
 import mmap
+import posixpath
+import re
+from xml.etree import ElementTree
+import zipfile
+import zlib
 import pyexcel
 from pyexcel._compact import zip_longest
 import defusedxml
@@ -7,6 +16,15 @@ import defusedxml
 defusedxml.defuse_stdlib()
 
 
+def cp1252_fallback(error):
+    """A decoding error handler that treats any bytes that aren't valid in
+    the file's encoding as Windows-1252"""
+    return error.object[error.start:error.end].decode('cp1252', 'replace'), error.end
+
+
+codecs.register_error('cp1252_fallback', cp1252_fallback)
+
+
 class file_without_nulls_or_cp1252(object):
     """An object that behaves like a provided file object,
     but strips any NULL bytes when read() is called, and
@@ -71,7 +89,11 @@ class PyExcelReader(object):
         file_field.open()  # Might have already been read once
         # The XLS reader doesn't accept a stream, but does accept an mmap file...
         if ext in ('xls', 'xlsx'):
-            kwargs['file_content'] = mmap.mmap(file_field.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                kwargs['file_content'] = mmap.mmap(file_field.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, io.UnsupportedOperation):
+                # Small uploads are held in memory, with no file to map
+                kwargs['file_content'] = file_field.read()
             if ext == 'xlsx':
                 kwargs['library'] = 'pyexcel-xlsx'
         elif ext == 'csv':
@@ -109,3 +131,248 @@ class PyExcelReader(object):
 
     def __iter__(self):
         return self
+
+    def rows(self):
+        """Yields the remaining rows as lists of values, in the file's
+        column order, without the cost of making a dict of each"""
+        self.fieldnames  # for the side effect
+        for row in self.reader:
+            if row != []:
+                yield row
+
+
+class without_nulls(io.RawIOBase):
+    """A binary stream reading from a provided file object, with any NULL
+    bytes removed a block at a time"""
+    def __init__(self, f):
+        self._file = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            data = self._file.read(len(b))
+            if not data:
+                return 0
+            data = data.replace(b'\0', b'')
+            if data:
+                b[:len(data)] = data
+                return len(data)
+
+
+class CSVReader(PyExcelReader):
+    """A faster reader just for CSV files. The encoding is worked out once
+    from the start of the file, rather than line by line, and rows are parsed
+    by the csv module without any type detection."""
+    BUFFER_SIZE = 1024 * 1024
+    SAMPLE_SIZE = 64 * 1024
+
+    def __init__(self, file_field):
+        self._fieldnames = None
+        file_field.open()  # Might have already been read once
+        stream = io.BufferedReader(without_nulls(file_field), buffer_size=self.BUFFER_SIZE)
+        encoding = self.detect_encoding(stream.peek(self.SAMPLE_SIZE)[:self.SAMPLE_SIZE])
+        text = io.TextIOWrapper(stream, encoding=encoding, errors='cp1252_fallback', newline='')
+        self.reader = csv.reader(text)
+
+    @staticmethod
+    def detect_encoding(sample):
+        if sample.startswith(codecs.BOM_UTF8):
+            return 'utf-8-sig'
+        try:
+            sample.decode('utf-8')
+        except UnicodeDecodeError as e:
+            # The sample may have cut a character in half
+            if e.start < len(sample) - 3:
+                return 'cp1252'
+        # Any odd lines later on will still be read as Windows-1252
+        return 'utf-8'
+
+
+class CSVWriter(object):
+    """Writes rows, as sequences of values in column order, to a file as CSV.
+    Rows are collected in memory and written out in large blocks. Given an
+    encoding, the file should be a binary one."""
+    def __init__(self, f, fieldnames=None, buffer_size=1024 * 1024, encoding=None):
+        self.file = f
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        if fieldnames:
+            self.writer.writerow(fieldnames)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writer.writerow(row)
+            if self.buffer.tell() >= self.buffer_size:
+                self.flush()
+
+    def write(self, data):
+        """Adds some already formatted CSV"""
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        data = self.buffer.getvalue()
+        self.file.write(data.encode(self.encoding) if self.encoding else data)
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def complete(self):
+        """Writes everything out, leaving a complete file (though more rows
+        can still be added after)"""
+        self.flush()
+
+
+class GzipCSVWriter(CSVWriter):
+    """Writes CSV to a binary file as gzipped UTF-8, compressing it as it
+    goes. Each complete() ends a gzip member, so the file so far can be used
+    as is; gzip treats members written after that as part of the same file."""
+    def __init__(self, f, fieldnames=None, buffer_size=1024 * 1024, encoding='utf-8'):
+        self.compressor = zlib.compressobj(wbits=31)
+        super(GzipCSVWriter, self).__init__(f, fieldnames, buffer_size, encoding)
+
+    def flush(self):
+        self.file.write(self.compressor.compress(self.buffer.getvalue().encode(self.encoding)))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def complete(self):
+        self.flush()
+        self.file.write(self.compressor.flush())
+        self.compressor = zlib.compressobj(wbits=31)
+
+
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+# Built in number formats that are dates and/or times
+XLSX_DATE_FORMATS = set(range(14, 23)) | set(range(45, 48))
+# Custom number formats are dates if they contain these outside quotes/brackets
+XLSX_DATE_FORMAT_CODE = re.compile(r'[dmyhs]', re.IGNORECASE)
+XLSX_NOT_FORMAT_CODE = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+XLSX_CELL_COLUMN = re.compile(r'[A-Z]+')
+
+
+class XLSXReader(PyExcelReader):
+    """Streams the rows of the first sheet of an XLSX file straight from its
+    XML, a row at a time, rather than loading the whole workbook. Only the
+    shared strings table is held in memory."""
+
+    def __init__(self, file_field):
+        self._fieldnames = None
+        file_field.open()  # Might have already been read once
+        self.reader = self.read_rows(zipfile.ZipFile(file_field))
+
+    def read_rows(self, archive):
+        sheet, shared_strings, date_styles, epoch = self.read_workbook(archive)
+        with archive.open(sheet) as f:
+            sheet_data = None
+            row = []
+            for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == XLSX_NS + 'sheetData':
+                        sheet_data = element
+                elif element.tag == XLSX_NS + 'c':
+                    ref = element.get('r')
+                    if ref:
+                        column = self.column_index(ref)
+                        if column > len(row):
+                            row.extend([''] * (column - len(row)))
+                    row.append(self.cell_value(element, shared_strings, date_styles, epoch))
+                elif element.tag == XLSX_NS + 'row':
+                    yield row
+                    row = []
+                    # Throw away the rows done so far
+                    sheet_data.clear()
+
+    def read_workbook(self, archive):
+        """Returns the path of the first sheet, the shared strings, the
+        styles that are dates, and the date epoch of the workbook"""
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        targets = {}
+        for rel in rels.iter(XLSX_PACKAGE_REL_NS + 'Relationship'):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join('xl', target))
+            targets[rel.get('Id')] = target
+            targets[rel.get('Type').rsplit('/', 1)[-1]] = target
+
+        sheet = workbook.find('%ssheets/%ssheet' % (XLSX_NS, XLSX_NS))
+        sheet = targets[sheet.get(XLSX_REL_NS + 'id')]
+
+        shared_strings = []
+        if 'sharedStrings' in targets:
+            with archive.open(targets['sharedStrings']) as f:
+                for event, element in ElementTree.iterparse(f):
+                    if element.tag == XLSX_NS + 'si':
+                        shared_strings.append(self.text(element))
+                        element.clear()
+
+        date_styles = set()
+        if 'styles' in targets:
+            styles = ElementTree.fromstring(archive.read(targets['styles']))
+            date_formats = set(XLSX_DATE_FORMATS)
+            for number_format in styles.iter(XLSX_NS + 'numFmt'):
+                code = XLSX_NOT_FORMAT_CODE.sub('', number_format.get('formatCode', ''))
+                if XLSX_DATE_FORMAT_CODE.search(code):
+                    date_formats.add(int(number_format.get('numFmtId')))
+            cell_formats = styles.find(XLSX_NS + 'cellXfs')
+            if cell_formats is not None:
+                for i, xf in enumerate(cell_formats.iter(XLSX_NS + 'xf')):
+                    if int(xf.get('numFmtId', 0)) in date_formats:
+                        date_styles.add(str(i))
+
+        properties = workbook.find(XLSX_NS + 'workbookPr')
+        if properties is not None and properties.get('date1904') in ('1', 'true'):
+            epoch = datetime(1904, 1, 1)
+        else:
+            epoch = datetime(1899, 12, 30)
+        return sheet, shared_strings, date_styles, epoch
+
+    @staticmethod
+    def text(element):
+        """The text of a shared or inline string, which might be in runs,
+        leaving out any phonetic guides"""
+        parts = []
+        for child in element:
+            if child.tag == XLSX_NS + 't':
+                parts.append(child.text or '')
+            elif child.tag == XLSX_NS + 'r':
+                parts.extend(t.text or '' for t in child.iter(XLSX_NS + 't'))
+        return ''.join(parts)
+
+    @staticmethod
+    def column_index(ref):
+        index = 0
+        for letter in XLSX_CELL_COLUMN.match(ref).group():
+            index = index * 26 + ord(letter) - ord('A') + 1
+        return index - 1
+
+    def cell_value(self, cell, shared_strings, date_styles, epoch):
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            inline = cell.find(XLSX_NS + 'is')
+            return self.text(inline) if inline is not None else ''
+        value = cell.findtext(XLSX_NS + 'v')
+        if value is None:
+            return ''
+        if cell_type == 's':
+            return shared_strings[int(value)]
+        if cell_type == 'b':
+            return value == '1'
+        if cell_type == 'n':
+            number = float(value)
+            if cell.get('s') in date_styles:
+                if epoch.year == 1899 and number < 60:
+                    number += 1  # Excel thinks 1900 was a leap year
+                date = epoch + timedelta(days=number)
+                return date.date() if number.is_integer() else date
+            return int(number) if number.is_integer() else number
+        return value
@@ -1,16 +1,9 @@
 # encoding: utf-8
 
-import re
 from django import forms
-from django.utils.encoding import smart_str
 
-from ukpostcodeutils.validation import is_valid_postcode
-
-from .models import OutputOption
-
-
-def clean_postcode(pc):
-    return re.sub('[^A-Z0-9]', '', smart_str(pc).upper())
+from .models import OUTPUT_FORMATS, OutputOption
+from .postcodes import clean_postcodes
 
 
 class CSVForm(forms.Form):
@@ -64,14 +57,20 @@ class PostcodeFieldForm(forms.Form):
             return cleaned_data
 
         bad_row_numbers = []
-        if not num_rows:
-            bad_rows = num_rows = 0
-            for i, row in enumerate(self.bulk_lookup.original_file_reader()):
-                postcode = clean_postcode(row[postcode_field])
-                num_rows += 1
-                if not is_valid_postcode(postcode):
-                    bad_rows += 1
-                    bad_row_numbers.append(str(i + 1))
+        profile = self.bulk_lookup.profile
+        if not num_rows and profile:
+            index = profile['fieldnames'].index(postcode_field)
+            num_rows = profile['num_rows']
+            bad_rows = num_rows - profile['valid_postcodes'][index]
+            bad_row_numbers = [str(i) for i in profile['bad_rows'][index]]
+            self.data['postcode_field-num_rows'] = num_rows
+            self.data['postcode_field-bad_rows'] = bad_rows
+        elif not num_rows:
+            postcodes, valid = clean_postcodes(
+                row[postcode_field] for row in self.bulk_lookup.original_file_reader())
+            num_rows = len(valid)
+            bad_row_numbers = [str(i + 1) for i, ok in enumerate(valid) if not ok]
+            bad_rows = len(bad_row_numbers)
             self.data['postcode_field-num_rows'] = num_rows
             self.data['postcode_field-bad_rows'] = bad_rows
 
@@ -88,6 +87,8 @@ class PostcodeFieldForm(forms.Form):
             else:
                 msg = 'Rows: '
                 msg += ', '.join(bad_row_numbers)
+                if bad_rows > len(bad_row_numbers):
+                    msg += ' and %d others' % (bad_rows - len(bad_row_numbers))
                 msg += u' don’t seem to be valid postcodes.'
                 msg += ' Do you want us to skip them?'
             raise forms.ValidationError(msg)
@@ -101,6 +102,10 @@ class OutputOptionsForm(forms.Form):
         error_messages={'required': 'Please select at least one output'},
         queryset=OutputOption.objects.all(),
         widget=forms.CheckboxSelectMultiple)
+    output_format = forms.ChoiceField(
+        label='File format', choices=OUTPUT_FORMATS, initial='csv', widget=forms.RadioSelect,
+        help_text='''A compressed file is much quicker to download, but will need
+        unzipping before you can open it in a spreadsheet.''')
 
 
 class PersonalDetailsForm(forms.Form):
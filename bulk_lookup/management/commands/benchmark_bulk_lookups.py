@@ -0,0 +1,272 @@
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import random
+import tempfile
+import tracemalloc
+import zipfile
+from xml.sax.saxutils import escape
+
+import pyexcel
+
+from django.contrib.gis.geos import Point, Polygon
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mapit.models import Area, Code, CodeType, Generation, Geometry, Postcode, Type
+
+from ...csv import CSVWriter
+from ...models import BulkLookup, OutputOption, PostcodeAreas
+from ...postcodes import clean_postcodes
+from ...resolver import OutputProjector, PostcodeResolver
+from ...stats import JobStats, peak_memory
+
+FORMATS = ('csv', 'xls', 'xlsx', 'ods')
+XLS_MAX_ROWS = 65535
+
+# Fixture areas are a grid of squares of each type over this box (WGS84)
+BOUNDS = (-2.0, 52.0, -1.0, 53.0)
+AREA_TYPES = (('WMC', 'Benchmark constituency', 20), ('CTY', 'Benchmark county', 4))
+
+# Fixture postcodes are made up from these, giving 1,080,000 possibilities
+# that are valid but not in use, e.g. ZW10 1AB
+POSTCODE_SECOND = 'WXY'
+POSTCODE_INWARD = 'ABDEFGHJLNPQRSTUWXYZ'
+
+ODS_MANIFEST = '''<?xml version="1.0" encoding="UTF-8"?>
+<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">
+ <manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.spreadsheet"/>
+ <manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>
+</manifest:manifest>'''
+ODS_CONTENT_START = '''<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"
+ xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"
+ xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" office:version="1.2">
+<office:body><office:spreadsheet><table:table table:name="Sheet1">'''
+ODS_CONTENT_END = '</table:table></office:spreadsheet></office:body></office:document-content>'
+
+
+def fixture_postcode(i):
+    inward_letters = len(POSTCODE_INWARD) ** 2
+    i, inward = divmod(i, inward_letters)
+    i, sector = divmod(i, 10)
+    second, district = divmod(i, 90)
+    return 'Z%s%d %d%s%s' % (
+        POSTCODE_SECOND[second], district + 10, sector,
+        POSTCODE_INWARD[inward // len(POSTCODE_INWARD)], POSTCODE_INWARD[inward % len(POSTCODE_INWARD)])
+
+
+class Command(BaseCommand):
+    help = """Measures how quickly bulk lookups are read, cleaned, resolved and
+    written, using generated files and a made up set of postcodes and areas.
+    Everything is added to the database in a transaction that is rolled back.
+    Prints the results as JSON. Each stage is run over the whole file, so
+    this doesn't measure the memory use of processing a file a chunk at a
+    time as process_bulk_lookups does."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=100000,
+            help='Number of rows in each generated file (default 100000)')
+        parser.add_argument(
+            '--duplication', type=float, default=0.5,
+            help='Proportion of rows that repeat an earlier postcode (default 0.5)')
+        parser.add_argument(
+            '--formats', default=','.join(FORMATS),
+            help='Comma separated file formats to test (default %s)' % ','.join(FORMATS))
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows to resolve at once (default 1000)')
+        parser.add_argument(
+            '--precompute', action='store_true',
+            help='Fill in the precomputed postcode areas table first')
+        parser.add_argument(
+            '--trace-memory', action='store_true',
+            help='Also report the peak memory each stage allocates, which slows everything down')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='File to write the JSON results to, rather than standard output')
+
+    def handle(self, **options):
+        formats = options['formats'].split(',')
+        for file_format in formats:
+            if file_format not in FORMATS:
+                raise CommandError("Unknown format %s" % file_format)
+        if not 0 <= options['duplication'] < 1:
+            raise CommandError("--duplication must be at least 0 and less than 1")
+
+        self.chunk_size = options['chunk_size']
+        self.trace_memory = options['trace_memory']
+        self.random = random.Random(options['seed'])
+        self.postcodes = self.make_postcodes(options['rows'], options['duplication'])
+
+        results = {
+            'rows': options['rows'],
+            'duplication': options['duplication'],
+            'distinct_postcodes': len(set(self.postcodes)),
+            'chunk_size': self.chunk_size,
+            'precompute': options['precompute'],
+            'trace_memory': self.trace_memory,
+            'formats': {},
+        }
+        if self.trace_memory:
+            tracemalloc.start()
+        with transaction.atomic():
+            generation, output_options = self.load_fixture(options['precompute'])
+            with tempfile.TemporaryDirectory() as directory:
+                for file_format in formats:
+                    if file_format == 'xls' and options['rows'] > XLS_MAX_ROWS:
+                        results['formats'][file_format] = {
+                            'skipped': 'XLS files are limited to %d rows' % (XLS_MAX_ROWS + 1)}
+                        continue
+                    path = os.path.join(directory, 'benchmark.%s' % file_format)
+                    self.write_file(path, file_format)
+                    results['formats'][file_format] = self.benchmark(path, generation, output_options)
+            transaction.set_rollback(True)
+        if self.trace_memory:
+            tracemalloc.stop()
+        # ru_maxrss only ever goes up, so can only tell us about the run as a whole
+        results['peak_memory_kb'] = peak_memory()
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def make_postcodes(self, rows, duplication):
+        """Returns a column of fixture postcodes, where about duplication of
+        them repeat one already used"""
+        postcodes = []
+        distinct = 0
+        for i in range(rows):
+            if postcodes and self.random.random() < duplication:
+                postcodes.append(self.random.choice(postcodes))
+            else:
+                postcodes.append(fixture_postcode(distinct))
+                distinct += 1
+        return postcodes
+
+    def load_fixture(self, precompute):
+        """Adds a generation with a grid of areas of each type, and a postcode
+        for each distinct postcode used, at a random point within the grid"""
+        generation = Generation.objects.create(active=False, description='Bulk lookup benchmark')
+        gss, _ = CodeType.objects.get_or_create(code='gss', defaults={'description': 'GSS'})
+        west, south, east, north = BOUNDS
+        output_options = []
+        for code, name, size in AREA_TYPES:
+            area_type, _ = Type.objects.get_or_create(code=code, defaults={'description': name})
+            output_options.append(OutputOption(name=name, mapit_area_type=code))
+            width, height = (east - west) / size, (north - south) / size
+            for x, y in itertools.product(range(size), range(size)):
+                area = Area.objects.create(
+                    name='%s %d,%d' % (name, x, y), type=area_type,
+                    generation_low=generation, generation_high=generation)
+                Code.objects.create(area=area, type=gss, code='%s%06d' % (code, area.id))
+                polygon = Polygon.from_bbox((
+                    west + x * width, south + y * height, west + (x + 1) * width, south + (y + 1) * height))
+                polygon.srid = 4326
+                Geometry.objects.create(area=area, polygon=polygon)
+
+        distinct = sorted(set(clean_postcodes(self.postcodes)[0]))
+        for batch in range(0, len(distinct), 5000):
+            Postcode.objects.bulk_create([
+                Postcode(postcode=postcode, location=Point(
+                    self.random.uniform(west, east), self.random.uniform(south, north), srid=4326))
+                for postcode in distinct[batch:batch + 5000]
+            ], ignore_conflicts=True)
+
+        if precompute:
+            resolver = PostcodeResolver(generation.id, cache_size=0)
+            for batch in range(0, len(distinct), 5000):
+                area_ids = resolver.fetch_area_ids(distinct[batch:batch + 5000])
+                PostcodeAreas.objects.bulk_create([
+                    PostcodeAreas(generation=generation, postcode=postcode, areas=areas)
+                    for postcode, areas in area_ids.items()
+                ])
+        return generation, output_options
+
+    def generated_rows(self):
+        yield ['ID', 'Name', 'Postcode']
+        for i, postcode in enumerate(self.postcodes, 1):
+            yield [str(i), 'Person %d' % i, postcode]
+
+    def write_file(self, path, file_format):
+        if file_format == 'csv':
+            with open(path, 'w') as f:
+                writer = CSVWriter(f)
+                writer.writerows(self.generated_rows())
+                writer.flush()
+        elif file_format == 'ods':
+            # Our ODS reader can't write, so put together a minimal file by hand
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(zipfile.ZipInfo('mimetype'), 'application/vnd.oasis.opendocument.spreadsheet')
+                archive.writestr('META-INF/manifest.xml', ODS_MANIFEST)
+                with archive.open('content.xml', 'w') as f:
+                    f.write(ODS_CONTENT_START.encode('utf-8'))
+                    for row in self.generated_rows():
+                        f.write(('<table:table-row>%s</table:table-row>' % ''.join(
+                            '<table:table-cell office:value-type="string"><text:p>%s</text:p></table:table-cell>'
+                            % escape(value) for value in row)).encode('utf-8'))
+                    f.write(ODS_CONTENT_END.encode('utf-8'))
+        else:
+            pyexcel.save_as(array=list(self.generated_rows()), dest_file_name=path)
+
+    @contextmanager
+    def stage(self, stats, name):
+        """Times a stage (see JobStats.stage) and, with --trace-memory, notes
+        the most memory it allocated at any one time, over what was already
+        allocated when it started"""
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+        with stats.stage(name) as stage:
+            yield stage
+        if self.trace_memory:
+            self.peaks[name] = (tracemalloc.get_traced_memory()[1] - start) // 1024
+
+    def benchmark(self, path, generation, output_options):
+        """Runs each stage over the whole file in turn, so that each can be
+        measured on its own, and returns the measurements"""
+        stats = JobStats()
+        self.peaks = {}
+        projector = OutputProjector(output_options)
+        resolver = PostcodeResolver(generation.id)
+        with open(path, 'rb') as fp, stats.track_queries():
+            bulk_lookup = BulkLookup(original_file=File(fp, name=os.path.basename(path)), postcode_field='Postcode')
+
+            with self.stage(stats, 'read'):
+                reader = bulk_lookup.original_file_reader()
+                fieldnames = [str(name) for name in reader.fieldnames]
+                rows = list(reader.rows())
+            postcode_index = fieldnames.index('Postcode')
+            width = len(fieldnames)
+            chunks = [rows[i:i + self.chunk_size] for i in range(0, len(rows), self.chunk_size)]
+
+            with self.stage(stats, 'clean'):
+                cleaned = [clean_postcodes([row[postcode_index] for row in chunk]) for chunk in chunks]
+
+            with self.stage(stats, 'resolve'):
+                results = [resolver.resolve(set(itertools.compress(postcodes, valid)))
+                           for postcodes, valid in cleaned]
+
+            with self.stage(stats, 'write'):
+                with tempfile.TemporaryFile(mode='w+') as f:
+                    writer = CSVWriter(f, fieldnames + projector.field_names)
+                    for chunk, (postcodes, valid), result in zip(chunks, cleaned, results):
+                        writer.writerows(resolver.output_rows(chunk, postcodes, result, width, projector))
+                    writer.flush()
+
+        stages = stats.as_dict()
+        for name, stage in stages.items():
+            stage['rows'] = len(rows)
+            stage['rows_per_second'] = round(len(rows) / stage['seconds']) if stage['seconds'] else None
+            if name in self.peaks:
+                stage['peak_allocated_kb'] = self.peaks[name]
+        return {
+            'file_size': os.path.getsize(path),
+            'stages': stages,
+            'cache': {'hits': resolver.cache.hits, 'misses': resolver.cache.misses},
+        }
@@ -0,0 +1,102 @@
+from datetime import timedelta
+import gzip
+import itertools
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+from ...models import BulkLookup, delete_stored_file
+
+
+class Command(BaseCommand):
+    help = """Deletes the files of bulk lookups that finished more than
+    BULK_LOOKUP_KEEP_DAYS days ago, or that were uploaded but never paid for,
+    or failed too many times, that long ago. Output files that are being kept
+    for longer than that can be gzipped."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.BULK_LOOKUP_KEEP_DAYS,
+            help='Delete the files of jobs that finished more than this many days ago (default %d)' % (
+                settings.BULK_LOOKUP_KEEP_DAYS))
+        parser.add_argument(
+            '--compress-after', type=int, metavar='DAYS',
+            help='Also gzip output files of jobs that finished more than this many days ago, which must be '
+                 'at least BULK_LOOKUP_KEEP_DAYS (%d), as download links are promised to work until then, and less '
+                 'than --days' % (
+                     settings.BULK_LOOKUP_KEEP_DAYS))
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of jobs to clear at once (default 1000)')
+
+    def handle(self, **options):
+        if options['compress_after'] is not None and options['compress_after'] < settings.BULK_LOOKUP_KEEP_DAYS:
+            raise CommandError("--compress-after must be at least %d, so that emailed links keep working" % (
+                settings.BULK_LOOKUP_KEEP_DAYS))
+        if options['compress_after'] is not None and options['compress_after'] >= options['days']:
+            raise CommandError("--compress-after must be less than --days, or nothing would be compressed")
+        self.verbosity = options['verbosity']
+        self.batch_size = options['batch_size']
+        now = timezone.now()
+        cutoff = now - timedelta(days=options['days'])
+        # Matches the bulk_lookup_has_files index, so only jobs still with files are looked at
+        has_files = BulkLookup.objects.filter(~Q(original_file='') | ~Q(output_file=''), finished__isnull=False)
+
+        self.expire(has_files.filter(finished__lt=cutoff))
+        # Jobs that will never finish: never paid for, or given up on after MAX_RETRIES failures
+        unpaid = Q(charge_id='', created__lt=cutoff)
+        given_up = Q(error_count__gte=settings.MAX_RETRIES, last_error__lt=cutoff, started__isnull=True)
+        self.expire(BulkLookup.objects.filter(
+            ~Q(original_file='') | ~Q(output_file='') | ~Q(checkpoint_file=''), finished__isnull=True
+        ).filter(unpaid | given_up))
+        if options['compress_after'] is not None:
+            self.compress(has_files.filter(
+                finished__lt=now - timedelta(days=options['compress_after']), finished__gte=cutoff
+            ).exclude(output_file='').exclude(output_file__endswith='.gz'))
+
+    def expire(self, jobs):
+        """Deletes the files of the given jobs, then clears their file fields,
+        a batch at a time. A file that is already gone is no problem, so if
+        this is interrupted it can simply be run again."""
+        rows = jobs.values_list(
+            'id', 'original_file', 'output_file', 'checkpoint_file').iterator(chunk_size=self.batch_size)
+        # Original, output and checkpoint files are all stored the same way
+        storage = BulkLookup._meta.get_field('output_file').storage
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            for id, *names in batch:
+                for name in names:
+                    if name:
+                        delete_stored_file(storage, name)
+            BulkLookup.objects.filter(id__in=[id for id, *names in batch]).update(
+                original_file='', output_file='', checkpoint_file='', checkpoint_row=0, checkpoint_size=0)
+            count += len(batch)
+            if self.verbosity > 1:
+                self.stdout.write("Deleted the files of %d bulk lookups" % count)
+
+    def compress(self, jobs):
+        """Replaces the output file of each of the given jobs with a gzipped
+        copy. The link to the uncompressed file sent out by email stops
+        working, which is why only files kept beyond what the email promises
+        are compressed."""
+        storage = BulkLookup._meta.get_field('output_file').storage
+        count = 0
+        for id, output_file in jobs.values_list('id', 'output_file').iterator(chunk_size=self.batch_size):
+            with tempfile.TemporaryFile() as f:
+                with storage.open(output_file, 'rb') as original, gzip.GzipFile(fileobj=f, mode='wb') as compressed:
+                    shutil.copyfileobj(original, compressed)
+                f.seek(0)
+                name = storage.save(output_file + '.gz', File(f))
+            BulkLookup.objects.filter(id=id).update(output_file=name)
+            storage.delete(output_file)
+            count += 1
+        if self.verbosity > 1:
+            self.stdout.write("Compressed %d output files" % count)
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from mapit.models import Generation, Postcode
+
+from ...models import PostcodeAreas
+from ...resolver import PostcodeResolver
+
+
+class Command(BaseCommand):
+    help = """Works out the areas of every postcode in the current generation,
+    for bulk lookups to use instead of spatial queries. Does nothing if this has
+    already been done for the current generation, and carries on from where it
+    got to if it was interrupted. Only new postcodes are noticed, so run it
+    with --force after importing postcodes that may have moved (or areas that
+    have changed) without creating a new generation."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of postcodes to look up at once (default 5000)')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Rebuild even if the current generation is already done, e.g. after a postcode import '
+                 'into the same generation')
+
+    def handle(self, **options):
+        generation = Generation.objects.current()
+        if not generation:
+            raise CommandError("There is no current generation")
+
+        existing = PostcodeAreas.objects.filter(generation=generation)
+        if options['force']:
+            existing.delete()
+        elif existing.count() >= Postcode.objects.count():
+            if options['verbosity'] > 1:
+                self.stdout.write("Generation %d is already done" % generation.id)
+            return
+
+        resolver = PostcodeResolver(generation.id, cache_size=0)
+        batch_size = options['batch_size']
+        # Postcodes are done in batches in order of ID, each batch in one
+        # transaction, so anything up to the last one stored has been done
+        last_id = Postcode.objects.filter(
+            postcode__in=existing.values('postcode')).aggregate(last_id=Max('id'))['last_id'] or 0
+        count = 0
+        while True:
+            batch = list(Postcode.objects.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'postcode')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            area_ids = resolver.fetch_area_ids([postcode for _, postcode in batch])
+            with transaction.atomic():
+                # Anything already there (e.g. a postcode added since) is left alone
+                PostcodeAreas.objects.bulk_create([
+                    PostcodeAreas(generation=generation, postcode=postcode, areas=areas)
+                    for postcode, areas in area_ids.items()
+                ], ignore_conflicts=True)
+            count += len(batch)
+            if options['verbosity'] > 1:
+                self.stdout.write("Done %d postcodes" % count)
+
+        # Older generations are no longer needed
+        PostcodeAreas.objects.exclude(generation=generation).delete()
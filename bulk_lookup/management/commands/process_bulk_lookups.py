@@ -1,108 +1,445 @@
-from collections import defaultdict, OrderedDict
+from collections import deque
+import itertools
+import json
+import logging
+import multiprocessing
 import os
+import select
+import shutil
+import signal
+import socket
 import tempfile
+import time
 import traceback
-import pyexcel
 import defusedxml
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.db.models import Q
+from django.db import connection, transaction, OperationalError
 from django.utils import timezone
 from django.core.files import File
 from django.core.mail import send_mail
 from django.contrib.sites.shortcuts import get_current_site
 
-from ukpostcodeutils.validation import is_valid_postcode
+from ...csv import CSVWriter, GzipCSVWriter
+from ...models import BulkLookup, NOTIFY_CHANNEL, delete_stored_file
+from ...resolver import OutputProjector, PostcodeResolver
+from ...stats import JobStats
+from ... import workers
 
-from ...models import BulkLookup
-from ...forms import clean_postcode
-
-from mapit.models import Postcode, Area, Generation
-from mapit.views.areas import add_codes
+from mapit.models import Generation
 
 defusedxml.defuse_stdlib()
 
+logger = logging.getLogger(__name__)
+
+
+# Seconds between updates of a running job's heartbeat
+HEARTBEAT_INTERVAL = 60
+
+
+class JobPaused(Exception):
+    """Raised when a job has used up its time slice, and has saved a
+    checkpoint so that it can carry on later"""
+
+
+class LeaseLost(Exception):
+    """Raised when a job we were processing has been released (see
+    BulkLookupQuerySet.release_stale), and so may now be someone else's"""
+
 
 class Command(BaseCommand):
     help = "Processes all the bulk lookup jobs that need processing"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows to read and look up at once (default 1000)')
+        parser.add_argument(
+            '--cache-size', type=int, default=100000,
+            help='Number of postcodes to remember the areas of between chunks and jobs (default 100000)')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes to look up chunks of each job in parallel (default 1)')
+        parser.add_argument(
+            '--checkpoint-interval', type=int, default=100000,
+            help='Save progress every this many rows, so a failed job can carry on from there (default 100000)')
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running, processing jobs as soon as they are paid for')
+        parser.add_argument(
+            '--poll-interval', type=int, default=60,
+            help='In daemon mode, seconds between checks if no notification arrives (default 60)')
+        parser.add_argument(
+            '--time-slice', type=int, default=600,
+            help='Seconds to work on one job before checkpointing it and letting others waiting go first, '
+                 'or 0 for no limit (default 600)')
+        parser.add_argument(
+            '--lease-timeout', type=int, default=600,
+            help='Seconds without a heartbeat after which a started job is assumed to have died, '
+                 'and is put back in the queue (default 600)')
+
     def handle(self, *args, **options):
+        self.chunk_size = options['chunk_size']
+        self.cache_size = options['cache_size']
+        self.verbosity = options['verbosity']
+        self.workers = options['workers']
+        self.checkpoint_interval = options['checkpoint_interval']
+        self.time_slice = options['time_slice']
+        self.lease_timeout = options['lease_timeout']
+        self.generation = None
+        self.resolver = None
+        self.pool = None
+        # Cleared by SIGTERM or SIGINT in daemon mode
+        self.running = True
+
+        try:
+            if options['daemon']:
+                self.run_daemon(options['poll_interval'])
+            else:
+                self.setup(self.current_generation())
+                self.process_jobs()
+        finally:
+            self.close_pool()
+
+    def current_generation(self):
         generation = Generation.objects.current()
-        generation = generation.id if generation else generation
-        self.generation_query = Q(generation_low__lte=generation, generation_high__gte=generation)
+        return generation.id if generation else generation
+
+    def setup(self, generation):
+        """Sets up the postcode cache (and worker pool) for a generation,
+        which can then be used for every job until the generation changes"""
+        self.close_pool()
+        self.generation = generation
+        self.resolver = PostcodeResolver(generation, cache_size=self.cache_size)
+        if self.workers > 1:
+            # Spawned rather than forked, so that no worker shares our database connection
+            self.pool = multiprocessing.get_context('spawn').Pool(
+                self.workers, initializer=workers.init_worker,
+                initargs=(generation, self.cache_size))
+
+    def close_pool(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def process_jobs(self):
+        """Processes jobs in order of priority until there are none left, or
+        we've been asked to stop. Jobs that were paused go back in the queue;
+        any that fail are left until next time. First, any jobs whose process
+        seems to have died are put back in the queue."""
+        released = BulkLookup.objects.release_stale(self.lease_timeout)
+        if released and self.verbosity > 1:
+            self.stdout.write("Released %d bulk lookups with no heartbeat" % released)
+        self.failed = []
+        while self.running and self.process_job():
+            pass
+
+    def run_daemon(self, poll_interval):
+        """Processes jobs whenever a BulkLookup is ready (see
+        BulkLookup.notify_ready) or every poll_interval seconds, until
+        SIGTERM or SIGINT. A job in progress is checkpointed and put back in
+        the queue at the end of its current chunk before exiting."""
+        def stop(signum, frame):
+            self.running = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        # Have signals wake us up from select()
+        wakeup, wakeup_write = socket.socketpair()
+        wakeup.setblocking(False)
+        wakeup_write.setblocking(False)
+        signal.set_wakeup_fd(wakeup_write.fileno())
+
+        while self.running:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN %s' % NOTIFY_CHANNEL)
+                generation = self.current_generation()
+                if self.resolver is None or generation != self.generation:
+                    self.setup(generation)
+                self.process_jobs()
+                if not self.running:
+                    break
+                pg_connection = connection.connection
+                if pg_connection.notifies:
+                    # Arrived while we were busy, so go round again straight away
+                    pg_connection.notifies.clear()
+                    continue
+                readable, _, _ = select.select([pg_connection, wakeup], [], [], poll_interval)
+                if pg_connection in readable:
+                    pg_connection.poll()
+                    pg_connection.notifies.clear()
+                if wakeup in readable:
+                    wakeup.recv(4096)
+            except OperationalError:
+                # Lost the database; reconnect (and listen again) next time round
+                traceback.print_exc()
+                connection.close()
+                select.select([wakeup], [], [], poll_interval)
 
-        for bulk_lookup in BulkLookup.objects.needs_processing():
-            self.process_job(bulk_lookup)
+        signal.set_wakeup_fd(-1)
+        wakeup.close()
+        wakeup_write.close()
 
-    def process_job(self, bulk_lookup):
+    def process_job(self):
+        """Claims the job that should go next and processes it. Returns False
+        if there was nothing to claim. The claim is committed straight away,
+        and the job processed outside of any transaction, renewing its lease
+        with a heartbeat as it goes."""
+        bulk_lookup = None
+        self.stats = None
         try:
             with transaction.atomic():
-                # Get a row level lock before processing
-                try:
-                    lock = BulkLookup.objects.select_for_update(skip_locked=True).get(pk=bulk_lookup.pk)
-                    # Just check it hasn't been dealt with in the time since the list was fetched
-                    if lock.started:
-                        return
-                except BulkLookup.DoesNotExist:
-                    return
-
-                bulk_lookup.started = timezone.now()
-                bulk_lookup.save()
+                bulk_lookup = BulkLookup.objects.claim_next(exclude=self.failed)
+            if bulk_lookup is None:
+                return False
+
+            self.stats = JobStats()
+            self.rows_done = 0
+            self.checkpoint_path = None
+            self.cache_start = (self.resolver.cache.hits, self.resolver.cache.misses)
+            self.slice_end = time.monotonic() + self.time_slice
+            self.last_heartbeat = time.monotonic()
+            with self.stats.track_queries():
                 self.do_lookup(bulk_lookup)
-                bulk_lookup.finished = timezone.now()
-                bulk_lookup.save()
-                self.send_success_email(bulk_lookup)
+            # Emailed before the job is marked finished, so that if sending
+            # fails the job is retried like any other failure
+            self.send_success_email(bulk_lookup)
+            self.finish_job(bulk_lookup)
+        except JobPaused:
+            self.record_stats(bulk_lookup, outcome='paused')
+            self.release_job(bulk_lookup, stats=bulk_lookup.stats)
+        except LeaseLost:
+            self.stderr.write("Bulk lookup %d was released while we were processing it" % bulk_lookup.pk)
         except Exception:
+            if bulk_lookup is None:
+                raise
             traceback.print_exc()
-            bulk_lookup.started = None
-            bulk_lookup.finished = None
-            bulk_lookup.error_count += 1
-            bulk_lookup.last_error = timezone.now()
-            bulk_lookup.save()
+            self.failed.append(bulk_lookup.pk)
+            if self.stats:
+                self.record_stats(bulk_lookup, outcome='failed')
+            self.release_job(
+                bulk_lookup, stats=bulk_lookup.stats,
+                error_count=bulk_lookup.error_count + 1, last_error=timezone.now())
+        return True
+
+    def update_job(self, bulk_lookup, **fields):
+        """Saves the given fields of a job, and its heartbeat, as long as it's
+        still ours. Raises LeaseLost if not."""
+        fields['heartbeat'] = timezone.now()
+        updated = BulkLookup.objects.filter(
+            pk=bulk_lookup.pk, started=bulk_lookup.started, finished__isnull=True
+        ).update(**fields)
+        if not updated:
+            raise LeaseLost()
+        for name, value in fields.items():
+            setattr(bulk_lookup, name, value)
+        self.last_heartbeat = time.monotonic()
+
+    def release_job(self, bulk_lookup, **fields):
+        """Puts a job back in the queue, unless it's no longer ours anyway"""
+        try:
+            self.update_job(bulk_lookup, started=None, **fields)
+        except LeaseLost:
+            pass
+
+    def finish_job(self, bulk_lookup):
+        """Marks the job done, then deletes its checkpoint, if any"""
+        self.record_stats(bulk_lookup)
+        old_checkpoint = bulk_lookup.checkpoint_file.name
+        self.update_job(
+            bulk_lookup, output_file=bulk_lookup.output_file.name, checkpoint_file='', checkpoint_row=0,
+            checkpoint_size=0, stats=bulk_lookup.stats, finished=timezone.now())
+        if old_checkpoint:
+            delete_stored_file(bulk_lookup.checkpoint_file.storage, old_checkpoint)
+
+    def record_stats(self, bulk_lookup, outcome='finished'):
+        """Stores how long each stage of the job took on the BulkLookup (to be
+        saved by the caller), and logs it. Cache hits are only those of this
+        process, so are zero when looking up with --workers. Peak memory is
+        the most this process used at any point it was sampled during the job,
+        not counting any --workers processes."""
+        self.stats.sample_memory()
+        stages = self.stats.as_dict()
+        bulk_lookup.stats = {
+            'stages': stages,
+            'rows': self.rows_done,
+            'cache_hits': self.resolver.cache.hits - self.cache_start[0],
+            'cache_misses': self.resolver.cache.misses - self.cache_start[1],
+            'peak_memory_kb': self.stats.peak_memory_kb,
+            'workers': self.workers,
+            'outcome': outcome,
+        }
+        for name, stage in stages.items():
+            logger.info(json.dumps(dict(stage, event='bulk_lookup_stage', bulk_lookup=bulk_lookup.pk, stage=name)))
+            if self.verbosity > 1:
+                self.stdout.write("Bulk lookup %d %s: %.3fs, %d queries, %d rows" % (
+                    bulk_lookup.pk, name, stage['seconds'], stage['queries'], stage['rows']))
+        summary = {key: value for key, value in bulk_lookup.stats.items() if key != 'stages'}
+        logger.info(json.dumps(dict(summary, event='bulk_lookup_job', bulk_lookup=bulk_lookup.pk)))
+        if self.verbosity > 1:
+            self.stdout.write("Bulk lookup %d: %d postcode cache hits, %d misses" % (
+                bulk_lookup.pk, summary['cache_hits'], summary['cache_misses']))
 
     def do_lookup(self, bulk_lookup):
-        self.column_names = bulk_lookup.output_field_names()
-
-        with tempfile.TemporaryFile(mode='w+') as f:
-            postcode_field = bulk_lookup.postcode_field
-            output_options = bulk_lookup.output_options.all()
-            self.header_row_done = False
-            rows = (self.lookup_row(row, postcode_field, output_options)
-                    for row in bulk_lookup.original_file_reader())
+        projector = OutputProjector(bulk_lookup.output_options.all())
+        column_names = list(bulk_lookup.field_names) + projector.field_names
+        writer_class = GzipCSVWriter if bulk_lookup.output_format == 'csv.gz' else CSVWriter
+
+        with tempfile.TemporaryFile() as f:
+            with self.stats.stage('read'):
+                reader = bulk_lookup.original_file_reader()
+                fieldnames = [str(name) for name in reader.fieldnames]
+                postcode_index = fieldnames.index(bulk_lookup.postcode_field)
+                width = len(fieldnames)
+                rows = reader.rows()
+            if bulk_lookup.checkpoint_row and bulk_lookup.checkpoint_file:
+                # Carry on from where a previous attempt got to
+                with self.stats.stage('checkpoint') as stage:
+                    with bulk_lookup.checkpoint_file.open('rb') as checkpoint:
+                        self.copy_checkpoint(checkpoint, f, bulk_lookup.checkpoint_size)
+                    stage['rows'] += bulk_lookup.checkpoint_row
+                with self.stats.stage('read'):
+                    rows = itertools.islice(rows, bulk_lookup.checkpoint_row, None)
+                writer = writer_class(f, encoding='utf-8')
+                self.rows_done = bulk_lookup.checkpoint_row
+            else:
+                writer = writer_class(f, column_names, encoding='utf-8')
+                self.rows_done = 0
+            chunks = self.read_chunks(rows)
             original_filename = os.path.basename(
                 bulk_lookup.original_file.name
             )
             base_filename, extension = os.path.splitext(original_filename)
-            output_filename = '%s-mapit.csv' % base_filename
-            pyexcel.isave_as(
-                dest_file_stream=f, dest_file_type='csv', records=rows,
-                auto_detect_float=False, auto_detect_int=False)
-            bulk_lookup.output_file.save(output_filename, File(f))
-
-    def lookup_row(self, row, postcode_field, output_options):
-        postcode = clean_postcode(row[postcode_field])
-        if is_valid_postcode(postcode):
-            try:
-                pc = Postcode.objects.get(postcode=postcode)
-                areas = list(add_codes(Area.objects.by_postcode(pc, self.generation_query)))
-                self.process_mapit_response(areas, row, output_options)
-            except Postcode.DoesNotExist:
-                pass
-        row = defaultdict(lambda: "", row)
-        if not self.header_row_done:
-            # The writer gets the column order by the first row being ordered
-            self.header_row_done = True
-            ret = OrderedDict()
-            for key in self.column_names:
-                ret[key] = row[key]
-            return ret
-        return row
-
-    def process_mapit_response(self, areas, row, output_options):
-        for output_option in output_options:
-            row.update(output_option.get_from_mapit_response(areas))
+            output_filename = '%s-mapit.%s' % (base_filename, bulk_lookup.output_format)
+            if self.pool:
+                self.lookup_parallel(bulk_lookup, writer, chunks, postcode_index, width, projector)
+            else:
+                for chunk in chunks:
+                    with self.stats.stage('lookup') as stage:
+                        output = self.resolver.lookup(chunk, postcode_index, width, projector)
+                        stage['rows'] += len(chunk)
+                    with self.stats.stage('write') as stage:
+                        writer.writerows(output)
+                        stage['rows'] += len(chunk)
+                    self.chunk_done(bulk_lookup, writer, len(chunk))
+            with self.stats.stage('upload') as stage:
+                writer.complete()
+                bulk_lookup.output_file.save(output_filename, File(f), save=False)
+                stage['rows'] += self.rows_done
+
+    def read_chunks(self, rows):
+        """Yields lists of consecutive rows, chunk_size rows at a time"""
+        while True:
+            with self.stats.stage('read') as stage:
+                chunk = list(itertools.islice(rows, self.chunk_size))
+                stage['rows'] += len(chunk)
+            if not chunk:
+                return
+            yield chunk
+
+    def lookup_parallel(self, bulk_lookup, writer, chunks, postcode_index, width, projector):
+        """Hands chunks out to the worker pool, writing the CSV each returns
+        in the original order. Only a few chunks per worker are read ahead.
+        The lookup stage is the time spent handing out chunks and waiting for
+        results, rather than the time the workers spent on them."""
+        pending = deque()
+        for chunk in chunks:
+            with self.stats.stage('lookup'):
+                pending.append((len(chunk), self.pool.apply_async(
+                    workers.lookup_chunk, (chunk, postcode_index, width, projector))))
+            if len(pending) >= self.workers * 2:
+                self.write_result(bulk_lookup, writer, *pending.popleft())
+        while pending:
+            self.write_result(bulk_lookup, writer, *pending.popleft())
+
+    def write_result(self, bulk_lookup, writer, rows, result):
+        with self.stats.stage('lookup') as stage:
+            output = result.get()
+            stage['rows'] += rows
+        with self.stats.stage('write') as stage:
+            writer.write(output)
+            stage['rows'] += rows
+        self.chunk_done(bulk_lookup, writer, rows)
+
+    def chunk_done(self, bulk_lookup, writer, rows):
+        """Counts rows once they have been written, and saves a checkpoint
+        every checkpoint_interval rows. Pauses the job if we've been asked to
+        stop, or if its time slice is up and a job is waiting that should go
+        ahead of the rest of this one. Jobs that failed earlier aren't
+        counted, as they won't be tried again until next time."""
+        self.rows_done += rows
+        self.stats.sample_memory()
+        if self.checkpoint_interval and self.rows_done - bulk_lookup.checkpoint_row >= self.checkpoint_interval:
+            self.save_checkpoint(bulk_lookup, writer)
+        elif time.monotonic() - self.last_heartbeat >= HEARTBEAT_INTERVAL:
+            self.update_job(bulk_lookup)
+        if not self.running:
+            self.pause(bulk_lookup, writer)
+        if self.time_slice and time.monotonic() >= self.slice_end:
+            if BulkLookup.objects.waiting_ahead(bulk_lookup, self.rows_done, exclude=self.failed):
+                self.pause(bulk_lookup, writer)
+            self.slice_end = time.monotonic() + self.time_slice
+
+    def pause(self, bulk_lookup, writer):
+        """Saves a checkpoint of the rows done so far, so that the job can be
+        put back in the queue and carry on from there later"""
+        if self.rows_done > bulk_lookup.checkpoint_row:
+            self.save_checkpoint(bulk_lookup, writer)
+        raise JobPaused()
+
+    def copy_checkpoint(self, checkpoint, f, size):
+        """Copies the first size bytes of a checkpoint (or all of it, if size
+        is 0) byte for byte, as anything after was never committed"""
+        if not size:
+            shutil.copyfileobj(checkpoint, f)
+            return
+        while size:
+            data = checkpoint.read(min(size, 1024 * 1024))
+            if not data:
+                raise IOError("Checkpoint is shorter than expected")
+            f.write(data)
+            size -= len(data)
+
+    def save_checkpoint(self, bulk_lookup, writer):
+        """Stores the output so far, and how many rows and bytes it covers.
+        The first checkpoint of a run uploads all the output so far to a new
+        file, replacing any previous checkpoint once the job points at it.
+        Later ones just append what's new to that file, where the storage
+        allows, so that the output isn't copied again every time; if an append
+        is cut short, the job still only covers the bytes it said before."""
+        with self.stats.stage('checkpoint') as stage:
+            writer.complete()
+            size = writer.file.tell()
+            storage = bulk_lookup.checkpoint_file.storage
+            if self.checkpoint_path:
+                writer.file.seek(bulk_lookup.checkpoint_size)
+                with open(self.checkpoint_path, 'r+b') as checkpoint:
+                    checkpoint.seek(bulk_lookup.checkpoint_size)
+                    checkpoint.truncate()
+                    shutil.copyfileobj(writer.file, checkpoint)
+                self.update_job(bulk_lookup, checkpoint_row=self.rows_done, checkpoint_size=size)
+            else:
+                old_checkpoint = bulk_lookup.checkpoint_file.name
+                bulk_lookup.checkpoint_file.save(
+                    '%d-checkpoint.%s' % (bulk_lookup.pk, bulk_lookup.output_format), File(writer.file), save=False)
+                try:
+                    self.update_job(
+                        bulk_lookup, checkpoint_file=bulk_lookup.checkpoint_file.name,
+                        checkpoint_row=self.rows_done, checkpoint_size=size)
+                except LeaseLost:
+                    delete_stored_file(storage, bulk_lookup.checkpoint_file.name)
+                    raise
+                if old_checkpoint:
+                    delete_stored_file(storage, old_checkpoint)
+                # Nobody else writes to this file, as each run starts its own
+                try:
+                    self.checkpoint_path = storage.path(bulk_lookup.checkpoint_file.name)
+                except NotImplementedError:
+                    pass
+            writer.file.seek(0, os.SEEK_END)
+            stage['rows'] += self.rows_done
 
     def send_success_email(self, bulk_lookup):
         url = ''.join([
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '__first__'),
+        ('bulk_lookup', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostcodeAreas',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('postcode', models.CharField(max_length=7)),
+                ('areas', models.JSONField(default=dict)),
+                ('generation', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mapit.generation')),
+            ],
+            options={
+                'verbose_name_plural': 'postcode areas',
+                'unique_together': {('generation', 'postcode')},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import bulk_lookup.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_lookup', '0002_postcodeareas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulklookup',
+            name='checkpoint_file',
+            field=models.FileField(blank=True, upload_to=bulk_lookup.models.checkpoint_file_upload_to),
+        ),
+        migrations.AddField(
+            model_name='bulklookup',
+            name='checkpoint_row',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_lookup', '0003_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulklookup',
+            name='profile',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_lookup', '0005_bulklookup_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bulklookup',
+            index=models.Index(
+                condition=models.Q(('started__isnull', True), models.Q(('charge_id', ''), _negated=True)),
+                fields=['error_count', 'last_error'], name='bulk_lookup_claimable'),
+        ),
+    ]
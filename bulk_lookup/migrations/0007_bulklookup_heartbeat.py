@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_lookup', '0006_bulklookup_claimable_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulklookup',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='bulklookup',
+            index=models.Index(
+                condition=models.Q(('finished__isnull', True), ('started__isnull', False)),
+                fields=['heartbeat'], name='bulk_lookup_running'),
+        ),
+    ]
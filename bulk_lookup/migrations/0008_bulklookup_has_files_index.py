@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_lookup', '0007_bulklookup_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bulklookup',
+            index=models.Index(
+                condition=models.Q(
+                    models.Q(
+                        models.Q(('original_file', ''), _negated=True),
+                        models.Q(('output_file', ''), _negated=True),
+                        _connector='OR'),
+                    ('finished__isnull', False)),
+                fields=['finished'], name='bulk_lookup_has_files'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_lookup', '0008_bulklookup_has_files_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulklookup',
+            name='output_format',
+            field=models.CharField(
+                choices=[('csv', 'CSV'), ('csv.gz', 'CSV, compressed with gzip')], default='csv', max_length=10),
+        ),
+    ]
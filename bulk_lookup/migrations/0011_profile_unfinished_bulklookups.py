@@ -0,0 +1,32 @@
+import traceback
+
+from django.db import migrations
+
+
+def profile_unfinished(apps, schema_editor):
+    """Jobs uploaded before profiles were kept would otherwise count as having
+    no rows, and so always be processed first. The historical model doesn't
+    have make_profile, so the current one is used to read each file."""
+    from bulk_lookup.models import BulkLookup as CurrentBulkLookup
+
+    BulkLookup = apps.get_model('bulk_lookup', 'BulkLookup')
+    jobs = BulkLookup.objects.filter(profile__isnull=True, finished__isnull=True).exclude(original_file='')
+    for job in jobs.iterator():
+        try:
+            profile = CurrentBulkLookup(original_file=job.original_file.name).make_profile()
+        except Exception:
+            # Left without a profile; it will fail when processed anyway
+            traceback.print_exc()
+            continue
+        BulkLookup.objects.filter(pk=job.pk).update(profile=profile)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_lookup', '0010_bulklookup_checkpoint_size'),
+    ]
+
+    operations = [
+        migrations.RunPython(profile_unfinished, migrations.RunPython.noop),
+    ]
@@ -2,12 +2,19 @@ import os
 import itertools
 from datetime import timedelta
 
-from django.db import models
+from django.db import connection, models
 from django.utils import timezone
 from django.conf import settings
 from django.utils.crypto import get_random_string
+from django.utils.encoding import force_str
 
-from .csv import PyExcelReader
+from .csv import CSVReader, PyExcelReader, XLSXReader
+from .postcodes import clean_postcodes
+
+# How many example rows, and invalid row numbers per column, to keep in an upload's profile
+PROFILE_EXAMPLE_ROWS = 5
+PROFILE_BAD_ROWS = 20
+PROFILE_CHUNK_SIZE = 10000
 
 
 class cache(object):
@@ -46,26 +53,131 @@ def output_file_upload_to(instance, filename):
     return random_folder_path('output_files', filename)
 
 
+def checkpoint_file_upload_to(instance, filename):
+    return random_folder_path('checkpoint_files', filename)
+
+
 def random_folder_path(base_folder, filename):
     random_folder = get_random_string(12)
     return os.path.join(base_folder, random_folder, filename)
 
 
+def delete_stored_file(storage, name):
+    """Deletes an uploaded, output or checkpoint file, and the randomly named
+    folder it has to itself"""
+    storage.delete(name)
+    try:
+        os.rmdir(os.path.dirname(storage.path(name)))
+    except (NotImplementedError, OSError):
+        pass
+
+
+# What output files can be, by their extension
+OUTPUT_FORMATS = (
+    ('csv', 'CSV'),
+    ('csv.gz', 'CSV, compressed with gzip'),
+)
+
+# Channel process_bulk_lookups --daemon listens on for new jobs
+NOTIFY_CHANNEL = 'bulk_lookup'
+
+# The order jobs should be processed in, lowest first: the rows a job has
+# left to do divided by its weight (free jobs for top tier subscribers have a
+# charge ID starting r_), less AGE_ROWS for every minute since it was created,
+# so that small jobs go ahead of big ones but nothing waits forever. Formatted
+# with the table (or alias) of the job and how many of its rows are done. Jobs
+# are profiled when uploaded or added in the admin, and older ones by
+# migration 0011, so only a job whose file can't be read has no row count.
+PRIORITY_SQL = '''
+GREATEST(COALESCE(({job}.profile->>'num_rows')::integer, 0) - {rows_done}, 0)
+    / CASE WHEN left({job}.charge_id, 2) = 'r_' THEN %(free_weight)s ELSE %(paid_weight)s END
+    - EXTRACT(EPOCH FROM %(now)s - {job}.created) / 60 * %(age_rows)s
+'''
+
+# Jobs that are waiting to be processed, other than those excluded: not
+# started, paid for, and not failed too often or too recently. The conditions
+# on started and charge_id match the bulk_lookup_claimable index.
+CLAIMABLE_SQL = '''
+{job}.started IS NULL
+AND {job}.charge_id <> ''
+AND {job}.error_count < %(max_retries)s
+AND ({job}.last_error IS NULL OR {job}.last_error < %(retry_time)s)
+AND NOT {job}.id = ANY(%(exclude)s)
+'''
+
+# Claims the waiting job that should go first, by marking it started,
+# skipping any that another process is claiming
+CLAIM_SQL = '''
+UPDATE bulk_lookup_bulklookup
+   SET started = %(now)s, heartbeat = %(now)s
+ WHERE id = (
+    SELECT id
+      FROM bulk_lookup_bulklookup job
+     WHERE {claimable}
+     ORDER BY {priority}, created
+     LIMIT 1
+       FOR UPDATE SKIP LOCKED
+ )
+RETURNING *
+'''.format(
+    claimable=CLAIMABLE_SQL.format(job='job'),
+    priority=PRIORITY_SQL.format(job='job', rows_done='job.checkpoint_row'))
+
+# Whether any waiting job would be claimed ahead of a running one, were it
+# put back in the queue having done rows_done rows
+WAITING_AHEAD_SQL = '''
+SELECT EXISTS (
+    SELECT 1
+      FROM bulk_lookup_bulklookup waiting, bulk_lookup_bulklookup running
+     WHERE running.id = %(running)s
+       AND {claimable}
+       AND ({waiting_priority}, waiting.created) < ({running_priority}, running.created)
+)
+'''.format(
+    claimable=CLAIMABLE_SQL.format(job='waiting'),
+    waiting_priority=PRIORITY_SQL.format(job='waiting', rows_done='waiting.checkpoint_row'),
+    running_priority=PRIORITY_SQL.format(job='running', rows_done='%(rows_done)s'))
+
+
 class BulkLookupQuerySet(models.QuerySet):
-    def needs_processing(self):
-        """
-        Bulk lookups that need processing:
-        - Haven't already started
-        - Have been paid (or got something in charge_id)
-        - Have failed less than MAX_RETRIES times already
-        - Last failed more than RETRY_INTERVAL minutes ago (if they've ever failed)
-        """
-        retry_minutes = settings.RETRY_INTERVAL
-        retry_time = timezone.now() - timedelta(minutes=retry_minutes)
-        retry_count = settings.MAX_RETRIES
-        return self.filter(started__isnull=True, error_count__lt=retry_count).exclude(charge_id='').filter(
-            models.Q(last_error__lt=retry_time) | models.Q(last_error=None)
-        ).distinct()
+    def queue_params(self, exclude):
+        now = timezone.now()
+        return {
+            'now': now,
+            'max_retries': settings.MAX_RETRIES,
+            'retry_time': now - timedelta(minutes=settings.RETRY_INTERVAL),
+            'exclude': list(exclude),
+            'free_weight': float(settings.BULK_LOOKUP_FREE_WEIGHT),
+            'paid_weight': float(settings.BULK_LOOKUP_PAID_WEIGHT),
+            'age_rows': float(settings.BULK_LOOKUP_AGE_ROWS),
+        }
+
+    def claim_next(self, exclude=()):
+        """Marks the job that needs processing first as started, and returns
+        it, or None if there's nothing to do. Whoever claims a job should keep
+        its heartbeat up to date until it's finished."""
+        jobs = list(self.raw(CLAIM_SQL, self.queue_params(exclude)))
+        return jobs[0] if jobs else None
+
+    def waiting_ahead(self, bulk_lookup, rows_done, exclude=()):
+        """Whether claim_next (with the same exclude) would pick another job
+        ahead of the given running one, if it was put back in the queue now"""
+        params = self.queue_params(exclude)
+        params.update(running=bulk_lookup.pk, rows_done=rows_done)
+        with connection.cursor() as cursor:
+            cursor.execute(WAITING_AHEAD_SQL, params)
+            return cursor.fetchone()[0]
+
+    def release_stale(self, lease_timeout):
+        """Puts started jobs that haven't had a heartbeat for lease_timeout
+        seconds back in the queue, as their process has presumably died.
+        This counts as an error, so that a job that keeps killing its
+        process is eventually given up on. Returns how many were released."""
+        now = timezone.now()
+        cutoff = now - timedelta(seconds=lease_timeout)
+        return self.filter(started__isnull=False, finished__isnull=True).filter(
+            models.Q(heartbeat__lt=cutoff) | models.Q(heartbeat=None, started__lt=cutoff)
+        ).update(started=None, heartbeat=None, error_count=models.F('error_count') + 1, last_error=now)
 
 
 class BulkLookup(models.Model):
@@ -77,22 +189,53 @@ class BulkLookup(models.Model):
         related_name='bulk_lookups',
         related_query_name='bulk_lookup'
     )
+    output_format = models.CharField(max_length=10, choices=OUTPUT_FORMATS, default='csv')
     email = models.EmailField()
     description = models.TextField(blank=True)
     bad_rows = models.IntegerField(blank=True, null=True)
+    # What we found out about the uploaded file when it was uploaded; see make_profile
+    profile = models.JSONField(blank=True, null=True)
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     started = models.DateTimeField(blank=True, null=True)
     finished = models.DateTimeField(blank=True, null=True)
+    # Updated regularly while a job is being processed; see release_stale
+    heartbeat = models.DateTimeField(blank=True, null=True)
     last_error = models.DateTimeField(blank=True, null=True)
     error_count = models.IntegerField(default=0, blank=False)
 
+    # Output so far, and how many input rows it covers, should a job fail part way.
+    # Only the first checkpoint_size bytes of the file count (0 for all of it).
+    checkpoint_file = models.FileField(upload_to=checkpoint_file_upload_to, blank=True)
+    checkpoint_row = models.IntegerField(default=0)
+    checkpoint_size = models.BigIntegerField(default=0)
+
+    # How long each stage of the last attempt at processing took; see process_bulk_lookups
+    stats = models.JSONField(blank=True, null=True)
+
     # From Stripe
     charge_id = models.CharField(max_length=255, blank=True)
 
     objects = BulkLookupQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            # Just the jobs that might need processing, for CLAIM_SQL
+            models.Index(
+                fields=['error_count', 'last_error'], name='bulk_lookup_claimable',
+                condition=models.Q(started__isnull=True) & ~models.Q(charge_id='')),
+            # Just the jobs being processed, for release_stale
+            models.Index(
+                fields=['heartbeat'], name='bulk_lookup_running',
+                condition=models.Q(started__isnull=False, finished__isnull=True)),
+            # Just the finished jobs whose files haven't been deleted yet, for expire_bulk_lookups
+            models.Index(
+                fields=['finished'], name='bulk_lookup_has_files',
+                condition=(
+                    (~models.Q(original_file='') | ~models.Q(output_file='')) & models.Q(finished__isnull=False))),
+        ]
+
     def __str__(self):
         return "{} - {} - {:%d %B %Y, %H:%I}".format(
             self.email,
@@ -100,28 +243,76 @@ class BulkLookup(models.Model):
             self.created
         )
 
+    def notify_ready(self):
+        """Lets a waiting process_bulk_lookups --daemon know there's a job
+        to do. Sent once any current transaction commits."""
+        with connection.cursor() as cursor:
+            cursor.execute('NOTIFY %s' % NOTIFY_CHANNEL)
+
     def postcode_field_choices(self):
         return [(f, f) for f in self.field_names]
 
     @cache
     def field_names(self):
+        if self.profile:
+            return list(self.profile['fieldnames'])
         return self.original_file_reader().fieldnames
 
     def example_rows(self):
-        return itertools.islice(self.original_file_reader(), 5)
+        if self.profile:
+            return [dict(zip(self.profile['fieldnames'], row)) for row in self.profile['example_rows']]
+        return itertools.islice(self.original_file_reader(), PROFILE_EXAMPLE_ROWS)
+
+    def make_profile(self):
+        """Reads through the uploaded file once, noting its header, some
+        example rows, how many rows it has, and how many valid postcodes
+        (and the first few invalid rows) there are in each column, so that
+        the wizard doesn't need to read it again."""
+        reader = self.original_file_reader()
+        fieldnames = [force_str(name) for name in reader.fieldnames or []]
+        width = len(fieldnames)
+        example_rows = []
+        valid_postcodes = [0] * width
+        bad_rows = [[] for name in fieldnames]
+        num_rows = 0
+        rows = reader.rows()
+        while True:
+            chunk = [list(row[:width]) + [''] * (width - len(row))
+                     for row in itertools.islice(rows, PROFILE_CHUNK_SIZE)]
+            if not chunk:
+                break
+            for row in chunk[:PROFILE_EXAMPLE_ROWS - len(example_rows)]:
+                example_rows.append([force_str(value) for value in row])
+            # Check each column of the chunk in one go
+            for i, column in enumerate(zip(*chunk)):
+                postcodes, valid = clean_postcodes(column)
+                valid_postcodes[i] += sum(valid)
+                if len(bad_rows[i]) < PROFILE_BAD_ROWS:
+                    bad_rows[i].extend(itertools.islice(
+                        (num_rows + n for n, ok in enumerate(valid, 1) if not ok),
+                        PROFILE_BAD_ROWS - len(bad_rows[i])))
+            num_rows += len(chunk)
+        return {
+            'fieldnames': fieldnames,
+            'example_rows': example_rows,
+            'num_rows': num_rows,
+            'valid_postcodes': valid_postcodes,
+            'bad_rows': bad_rows,
+        }
 
     def original_file_reader(self):
+        root, ext = os.path.splitext(self.original_file.name)
+        ext = ext.lower()
+        if ext in ('', '.csv'):
+            return CSVReader(self.original_file)
+        elif ext == '.xlsx':
+            return XLSXReader(self.original_file)
+        # XLS files can't be streamed, but are limited to 65,536 rows anyway
         return PyExcelReader(self.original_file)
 
     def output_file_name(self):
         return os.path.basename(self.output_file.name)
 
-    def output_field_names(self):
-        names = self.field_names
-        for option in self.output_options.all():
-            names += option.output_field_names()
-        return names
-
 
 class OutputOption(models.Model):
     name = models.CharField(max_length=500, blank=False)
@@ -137,13 +328,18 @@ class OutputOption(models.Model):
             "{0} - MapIt ID".format(self.name)
         ]
 
-    def get_from_mapit_response(self, areas):
-        """ Extract the right data from mapit's data """
-        fields = {f: "" for f in self.output_field_names()}
-        for area in areas:
-            if area.type.code == self.mapit_area_type:
-                fields["{0} - Name".format(self.name)] = area.name
-                fields["{0} - GSS Code".format(self.name)] = area.all_codes.get('gss', '')  # NOQA
-                fields["{0} - MapIt ID".format(self.name)] = area.id
-                break
-        return fields
+
+class PostcodeAreas(models.Model):
+    """The areas of a postcode in a generation, worked out in advance by the
+    precompute_postcode_areas command so that bulk lookups can skip the
+    spatial query. areas maps each area type code to an area ID."""
+    postcode = models.CharField(max_length=7)
+    generation = models.ForeignKey('mapit.Generation', on_delete=models.CASCADE, related_name='+')
+    areas = models.JSONField(default=dict)
+
+    class Meta:
+        unique_together = ('generation', 'postcode')
+        verbose_name_plural = 'postcode areas'
+
+    def __str__(self):
+        return '%s (generation %d)' % (self.postcode, self.generation_id)
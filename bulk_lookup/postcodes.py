@@ -0,0 +1,30 @@
+import re
+
+from django.utils.encoding import smart_str
+from ukpostcodeutils.validation import FULL_MATCH_REGEX
+
+NOT_POSTCODE_CHARACTERS = re.compile('[^A-Z0-9]')
+# Separates values when a column is cleaned as one string; it is removed by
+# cleaning like any other punctuation, so can't be left in a value
+SEPARATOR = '\n'
+NOT_POSTCODE_OR_SEPARATOR = re.compile('[^A-Z0-9%s]+' % SEPARATOR)
+
+
+def clean_postcodes(values):
+    """Cleans and validates a whole column of values at once. Returns a list
+    of the cleaned postcodes, and a list of whether each one is valid."""
+    values = [value if isinstance(value, str) else smart_str(value) for value in values]
+    column = SEPARATOR.join(values)
+    if column.count(SEPARATOR) == len(values) - 1:
+        # Spaces are by far the most common thing to remove, and much quicker
+        # to remove on their own; only use the regex if anything else is left
+        column = column.upper().replace(' ', '')
+        if NOT_POSTCODE_OR_SEPARATOR.search(column):
+            column = NOT_POSTCODE_OR_SEPARATOR.sub('', column)
+        cleaned = column.split(SEPARATOR)
+    else:
+        # Some value contains the separator itself, so do them one by one
+        cleaned = [NOT_POSTCODE_CHARACTERS.sub('', value.upper()) for value in values]
+    match = FULL_MATCH_REGEX.match
+    valid_postcodes = set(postcode for postcode in set(cleaned) if match(postcode))
+    return cleaned, [postcode in valid_postcodes for postcode in cleaned]
@@ -0,0 +1,236 @@
+from collections import namedtuple, OrderedDict
+import itertools
+
+from django.conf import settings
+from django.db import connection
+
+from mapit.models import Area
+from mapit.views.areas import add_codes
+
+from .models import PostcodeAreas
+from .postcodes import clean_postcodes
+
+# Postcodes are matched to areas both by point-in-polygon and by any areas
+# they have been directly associated with (e.g. Northern Ireland), mirroring
+# Area.objects.by_postcode, but for a whole set of postcodes at once. Postcodes
+# that exist but match no area in the generation come back with a NULL area.
+# Matches are ordered so that the first of each type is the one to use.
+POSTCODE_AREAS_SQL = '''
+WITH
+    postcode AS (
+        SELECT id, postcode, location FROM mapit_postcode WHERE postcode = ANY(%(postcodes)s)
+    ),
+    matches AS (
+        SELECT postcode.id AS postcode_id, geometry.area_id, 0 AS source
+          FROM postcode
+          JOIN mapit_geometry geometry
+            ON ST_Contains(geometry.polygon, ST_Transform(postcode.location, %(srid)s))
+        UNION
+        SELECT postcode_areas.postcode_id, postcode_areas.area_id, 1 AS source
+          FROM mapit_postcode_areas postcode_areas
+         WHERE postcode_areas.postcode_id IN (SELECT id FROM postcode)
+    )
+SELECT postcode.postcode, area.id, type.code
+  FROM postcode
+  LEFT JOIN matches ON matches.postcode_id = postcode.id
+  LEFT JOIN mapit_area area
+    ON area.id = matches.area_id
+   AND area.generation_low_id <= %(generation)s
+   AND area.generation_high_id >= %(generation)s
+  LEFT JOIN mapit_type type ON type.id = area.type_id
+ ORDER BY matches.source, area.name, area.type_id
+'''
+
+# Every area in a generation, with its GSS code if it has one
+GENERATION_AREAS_SQL = '''
+SELECT area.id, area.name, type.code, code.code
+  FROM mapit_area area
+  JOIN mapit_type type ON type.id = area.type_id
+  LEFT JOIN mapit_codetype code_type ON code_type.code = 'gss'
+  LEFT JOIN mapit_code code ON code.area_id = area.id AND code.type_id = code_type.id
+ WHERE area.generation_low_id <= %(generation)s
+   AND area.generation_high_id >= %(generation)s
+'''
+
+
+# Just the parts of an Area that OutputProjector needs
+LookupArea = namedtuple('LookupArea', ('id', 'name', 'type_code', 'gss'))
+
+
+class OutputProjector(object):
+    """Turns a postcode's areas into the extra columns for a job's output
+    options: the name, GSS code and ID of the area of each option's type, or
+    blanks if there isn't one. Made once per job, so that the column names
+    and types are only worked out the once."""
+
+    def __init__(self, output_options):
+        self.type_codes = [option.mapit_area_type for option in output_options]
+        self.field_names = [name for option in output_options for name in option.output_field_names()]
+        self.blank = ('',) * len(self.field_names)
+
+    def project(self, areas):
+        by_type = {}
+        for area in areas:
+            # The first area of each type is the one to use
+            by_type.setdefault(area.type_code, area)
+        values = []
+        for type_code in self.type_codes:
+            area = by_type.get(type_code)
+            if area is None:
+                values += ('', '', '')
+            else:
+                values += (area.name, area.gss, area.id)
+        return values
+
+
+class LRUCache(object):
+    """A dict-like cache holding at most max_size items, dropping the least
+    recently used item when full, and counting its hits and misses."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+
+class PostcodeResolver(object):
+    """Finds the areas for a batch of postcodes with a fixed number of
+    queries, however many postcodes are in the batch. Results are kept in an
+    LRU cache, so a resolver should only be used for a single generation."""
+
+    def __init__(self, generation, cache_size=100000):
+        self.generation = generation
+        self.cache = LRUCache(cache_size)
+        self.areas = None
+
+    def lookup(self, rows, postcode_index, width, projector):
+        """Looks up the distinct postcodes of a chunk of rows (lists of values)
+        in one go. Returns the rows, padded or cut to width columns, each with
+        the fields of every output option (see OutputProjector) added on the end."""
+        postcodes, valid = clean_postcodes(
+            [row[postcode_index] if postcode_index < len(row) else '' for row in rows])
+        results = self.resolve(set(itertools.compress(postcodes, valid)))
+        return self.output_rows(rows, postcodes, results, width, projector)
+
+    def output_rows(self, rows, postcodes, results, width, projector):
+        """Given rows, their cleaned postcodes, and what resolve returned for
+        those postcodes, returns the rows to output."""
+        blank = projector.blank
+        output = []
+        for row, postcode in zip(rows, postcodes):
+            row = list(row[:width])
+            if len(row) < width:
+                row.extend([''] * (width - len(row)))
+            areas = results.get(postcode)
+            if areas is None:
+                row.extend(blank)
+            else:
+                row.extend(projector.project(areas))
+            output.append(row)
+        return output
+
+    def resolve(self, postcodes):
+        """Given an iterable of clean, valid postcodes, returns a dict mapping
+        each postcode we know about to a tuple of its LookupAreas. Postcodes we
+        don't know about are left out."""
+        results = {}
+        missing = []
+        for postcode in postcodes:
+            try:
+                areas = self.cache[postcode]
+            except KeyError:
+                missing.append(postcode)
+                continue
+            if areas is not None:
+                results[postcode] = areas
+
+        found = self.fetch(missing)
+        for postcode in missing:
+            # Remember postcodes we don't know about too, as None
+            areas = found.get(postcode)
+            self.cache[postcode] = areas
+            if areas is not None:
+                results[postcode] = areas
+        return results
+
+    def fetch(self, postcodes):
+        """Looks up postcodes in the database, bypassing the cache. Postcodes
+        in the precomputed PostcodeAreas table for this generation are read
+        from there, any others with a spatial query."""
+        if not postcodes:
+            return {}
+
+        area_ids = dict(PostcodeAreas.objects.filter(
+            generation_id=self.generation, postcode__in=postcodes
+        ).values_list('postcode', 'areas'))
+        area_ids.update(self.fetch_area_ids([
+            postcode for postcode in postcodes if postcode not in area_ids]))
+
+        areas = self.get_areas(set(
+            area_id for ids in area_ids.values() for area_id in ids.values()))
+        return {
+            postcode: tuple(areas[area_id] for area_id in ids.values() if area_id in areas)
+            for postcode, ids in area_ids.items()
+        }
+
+    def fetch_area_ids(self, postcodes):
+        """Returns a dict mapping each postcode we know about to a dict of
+        area type code to the ID of its area of that type."""
+        if not postcodes:
+            return {}
+
+        area_ids = {}
+        with connection.cursor() as cursor:
+            cursor.execute(POSTCODE_AREAS_SQL, {
+                'postcodes': postcodes,
+                'srid': settings.MAPIT_AREA_SRID,
+                'generation': self.generation,
+            })
+            for postcode, area_id, type_code in cursor.fetchall():
+                ids = area_ids.setdefault(postcode, {})
+                if area_id is not None:
+                    ids.setdefault(type_code, area_id)
+        return area_ids
+
+    def load_areas(self):
+        """Reads every area of the generation, with its GSS code, in one go,
+        so that looking up areas is just a dict lookup from then on."""
+        self.areas = {}
+        with connection.cursor() as cursor:
+            cursor.execute(GENERATION_AREAS_SQL, {'generation': self.generation})
+            for area_id, name, type_code, gss in cursor.fetchall():
+                self.areas[area_id] = LookupArea(area_id, name, type_code, gss or '')
+
+    def get_areas(self, area_ids):
+        """Returns a dict of area ID to LookupArea including (at least) the
+        given areas. All the generation's areas are loaded the first time,
+        and any not among them (e.g. added since) are fetched as needed."""
+        if self.areas is None:
+            self.load_areas()
+        missing = area_ids - self.areas.keys()
+        if missing:
+            for area in add_codes(list(Area.objects.filter(id__in=missing))):
+                self.areas[area.id] = LookupArea(area.id, area.name, area.type.code, area.all_codes.get('gss', ''))
+        return self.areas
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+import os
+import resource
+import time
+
+from django.db import connection
+
+
+def peak_memory():
+    """The most memory this process has used so far, in kilobytes (as Linux
+    reports ru_maxrss)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_memory():
+    """How much memory this process is using right now, in kilobytes, or None
+    where /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class JobStats(object):
+    """Adds up the wall time, SQL queries and rows of each stage of a bulk
+    lookup. A stage can be entered any number of times, e.g. once per chunk,
+    but stages shouldn't be nested, as time in the inner one would be counted
+    in both. Queries are only counted while track_queries is active.
+
+    Memory is sampled with sample_memory, e.g. after each chunk, rather than
+    taken from ru_maxrss, which is the peak over the whole life of the process
+    and so would be shared by every job a long running process does."""
+
+    def __init__(self):
+        self.stages = {}
+        self.current = None
+        self.peak_memory_kb = None
+
+    @contextmanager
+    def stage(self, name):
+        stats = self.stages.setdefault(name, {'seconds': 0.0, 'queries': 0, 'rows': 0})
+        previous, self.current = self.current, stats
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats['seconds'] += time.perf_counter() - start
+            self.current = previous
+
+    def sample_memory(self):
+        memory = current_memory()
+        if memory is not None and (self.peak_memory_kb is None or memory > self.peak_memory_kb):
+            self.peak_memory_kb = memory
+
+    def count_query(self, execute, sql, params, many, context):
+        if self.current is not None:
+            self.current['queries'] += 1
+        return execute(sql, params, many, context)
+
+    def track_queries(self):
+        return connection.execute_wrapper(self.count_query)
+
+    def as_dict(self):
+        return {
+            name: dict(stats, seconds=round(stats['seconds'], 3))
+            for name, stats in self.stages.items()
+        }
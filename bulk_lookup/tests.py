@@ -1,12 +1,25 @@
+from datetime import timedelta
+import gzip
+import itertools
 import os
 from io import StringIO, BytesIO
 
+from mock import patch
+
+from django.contrib import admin
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.files.base import ContentFile, File
 from django.urls import reverse
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from mapit.models import Area, Code, CodeType, Generation, Postcode, Type
 
-from bulk_lookup import csv, models
+from bulk_lookup import csv, models, workers
+from bulk_lookup.management.commands import process_bulk_lookups
+from bulk_lookup.postcodes import clean_postcodes
+from bulk_lookup.resolver import LookupArea, LRUCache, OutputProjector, PostcodeResolver
 
 
 class BulkLookupViewTest(TestCase):
@@ -39,6 +52,17 @@ class BulkLookupViewTest(TestCase):
         self.assertContains(response, 'Different')
         self.assertEqual(len(response.context['form'].errors), 0)
 
+    def test_xls_upload(self):
+        # Small enough to be held in memory rather than written to a temporary file
+        with open(os.path.dirname(__file__) + '/fixtures/test.xls', 'rb') as fp:
+            response = self.client.post(reverse('home'), {
+                'wizard_view-current_step': 'csv',
+                'csv-original_file': fp,
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['form'].errors), 0)
+        self.assertContains(response, 'Annabel')
+
     def test_direct_mid_submissions(self):
         self.client.get(reverse('home'))
         self.client.post(reverse('home'), {
@@ -63,18 +87,365 @@ class BulkLookupViewTest(TestCase):
         b.output_options.add(o)
         call_command('process_bulk_lookups')
 
+    def create_areas(self):
+        generation = Generation.objects.create(active=True)
+        area = Area.objects.create(
+            name='Cities of London and Westminster',
+            type=Type.objects.create(code='WMC', description='UK Parliament constituency'),
+            generation_low=generation, generation_high=generation)
+        Code.objects.create(area=area, type=CodeType.objects.create(code='gss'), code='E14000639')
+        for postcode in ('SW1A1AA', 'SW1A0AA'):
+            Postcode.objects.create(postcode=postcode).areas.add(area)
+        return area
+
+    def create_job(self):
+        b = models.BulkLookup.objects.create(postcode_field='Postcode', charge_id='r_test')
+        b.original_file.save("test.csv", ContentFile(
+            "ID,Postcode\n1,SW1A 1AA\n2,EH11BB\n3,sw1a0aa\n4,Not a postcode\n5,SW1A1AA"))
+        o, _ = models.OutputOption.objects.get_or_create(name='Constituency', mapit_area_type='WMC')
+        b.output_options.add(o)
+        return b
+
+    def read_output(self, b):
+        b.refresh_from_db()
+        b.output_file.open('r')
+        return b.output_file.read().splitlines()
+
+    def run_lookup(self, **options):
+        b = self.create_job()
+        call_command('process_bulk_lookups', **options)
+        return self.read_output(b)
+
+    def lookup_output(self, area):
+        return [
+            'ID,Postcode,Constituency - Name,Constituency - GSS Code,Constituency - MapIt ID',
+            '1,SW1A 1AA,Cities of London and Westminster,E14000639,%d' % area.id,
+            '2,EH11BB,,,',
+            '3,sw1a0aa,Cities of London and Westminster,E14000639,%d' % area.id,
+            '4,Not a postcode,,,',
+            '5,SW1A1AA,Cities of London and Westminster,E14000639,%d' % area.id,
+        ]
+
+    def assertLookupOutput(self, lines, area):
+        self.assertEqual(lines, self.lookup_output(area))
+
+    def assertLookupOutputBytes(self, data, area):
+        # Exactly as csv.writer writes it, line endings and all
+        self.assertEqual(data, ''.join(line + '\r\n' for line in self.lookup_output(area)).encode('utf-8'))
+
+    def test_lookup(self):
+        area = self.create_areas()
+        self.assertLookupOutput(self.run_lookup(chunk_size=2), area)
+
+    def test_stats(self):
+        area = self.create_areas()
+        with self.assertLogs('bulk_lookup', 'INFO') as logs:
+            self.assertLookupOutput(self.run_lookup(chunk_size=2), area)
+        b = models.BulkLookup.objects.get()
+        self.assertEqual((b.stats['rows'], b.stats['outcome']), (5, 'finished'))
+        self.assertEqual(b.stats['stages']['read']['rows'], 5)
+        self.assertEqual(b.stats['stages']['lookup']['rows'], 5)
+        self.assertGreater(b.stats['stages']['lookup']['queries'], 0)
+        self.assertEqual((b.stats['cache_hits'], b.stats['cache_misses']), (1, 3))
+        self.assertGreater(b.stats['peak_memory_kb'], 0)
+        self.assertIn('"event": "bulk_lookup_job"', logs.output[-1])
+
+    def test_precomputed_lookup(self):
+        area = self.create_areas()
+        call_command('precompute_postcode_areas')
+        self.assertEqual(models.PostcodeAreas.objects.count(), 2)
+        self.assertEqual(models.PostcodeAreas.objects.get(postcode='SW1A1AA').areas, {'WMC': area.id})
+        # The precomputed areas are used rather than the live ones
+        area.postcodes.clear()
+        self.assertLookupOutput(self.run_lookup(), area)
+
+    def test_precompute_resumes(self):
+        area = self.create_areas()
+        # As if a run was interrupted after its first batch
+        models.PostcodeAreas.objects.create(generation=area.generation_low, postcode='SW1A1AA', areas={})
+        fetch_area_ids = PostcodeResolver.fetch_area_ids
+        with patch.object(PostcodeResolver, 'fetch_area_ids', autospec=True,
+                          side_effect=fetch_area_ids) as fetch:
+            call_command('precompute_postcode_areas', batch_size=1)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(models.PostcodeAreas.objects.get(postcode='SW1A1AA').areas, {})
+        self.assertEqual(models.PostcodeAreas.objects.get(postcode='SW1A0AA').areas, {'WMC': area.id})
+
+    def test_resume_from_checkpoint(self):
+        area = self.create_areas()
+        resolve = PostcodeResolver.resolve
+        calls = []
+
+        def flaky_resolve(resolver, postcodes):
+            calls.append(postcodes)
+            if len(calls) == 3:
+                raise Exception('Lost the database')
+            return resolve(resolver, postcodes)
+
+        b = self.create_job()
+        with patch.object(PostcodeResolver, 'resolve', flaky_resolve), \
+                patch('bulk_lookup.management.commands.process_bulk_lookups.traceback'):
+            call_command('process_bulk_lookups', chunk_size=1, checkpoint_interval=2)
+            b.refresh_from_db()
+            self.assertEqual((b.error_count, b.checkpoint_row), (1, 2))
+            first_checkpoint = b.checkpoint_file.path
+            call_command('process_bulk_lookups', chunk_size=1, checkpoint_interval=2)
+
+        # Only the rows after the checkpoint were looked up again
+        self.assertEqual(len(calls), 6)
+        b.refresh_from_db()
+        with b.output_file.open('rb') as f:
+            self.assertLookupOutputBytes(f.read(), area)
+        self.assertEqual((b.checkpoint_row, b.checkpoint_size, b.checkpoint_file.name), (0, 0, ''))
+        self.assertFalse(os.path.exists(os.path.dirname(first_checkpoint)))
+
+    def test_checkpoint_append(self):
+        area = self.create_areas()
+        resolve = PostcodeResolver.resolve
+        calls = []
+
+        def flaky_resolve(resolver, postcodes):
+            calls.append(postcodes)
+            if len(calls) == 5:
+                raise Exception('Lost the database')
+            return resolve(resolver, postcodes)
+
+        b = self.create_job()
+        with patch.object(PostcodeResolver, 'resolve', flaky_resolve), \
+                patch('bulk_lookup.management.commands.process_bulk_lookups.traceback'):
+            call_command('process_bulk_lookups', chunk_size=1, checkpoint_interval=2)
+        # The second checkpoint added its rows to the file the first uploaded
+        b.refresh_from_db()
+        self.assertEqual(b.checkpoint_row, 4)
+        with b.checkpoint_file.open('rb') as f:
+            data = f.read()
+        self.assertEqual(b.checkpoint_size, len(data))
+        self.assertEqual(data, ''.join(line + '\r\n' for line in self.lookup_output(area)[:5]).encode('utf-8'))
+
+    def test_release_stale(self):
+        area = self.create_areas()
+        b = self.create_job()
+        long_ago = timezone.now() - timedelta(hours=1)
+        models.BulkLookup.objects.filter(pk=b.pk).update(started=long_ago, heartbeat=long_ago)
+        running = self.create_job()
+        models.BulkLookup.objects.filter(pk=running.pk).update(started=timezone.now(), heartbeat=timezone.now())
+        call_command('process_bulk_lookups')
+        # The job whose process died was put back in the queue and done again
+        self.assertLookupOutput(self.read_output(b), area)
+        self.assertEqual(b.error_count, 1)
+        running.refresh_from_db()
+        self.assertEqual((running.finished, running.error_count), (None, 0))
+
+    def test_email_failure(self):
+        self.create_areas()
+        b = self.create_job()
+        with patch('bulk_lookup.management.commands.process_bulk_lookups.send_mail', side_effect=Exception), \
+                patch('bulk_lookup.management.commands.process_bulk_lookups.traceback'):
+            call_command('process_bulk_lookups')
+        # Left to be tried again, rather than marked finished with nobody told
+        b.refresh_from_db()
+        self.assertEqual((b.started, b.finished, b.error_count), (None, None, 1))
+        self.assertEqual(b.stats['outcome'], 'failed')
+
+    def test_time_slice(self):
+        area = self.create_areas()
+        first = self.create_job()
+        models.BulkLookup.objects.filter(pk=first.pk).update(profile={'num_rows': 5000})
+        jobs = [first]
+        lookup = PostcodeResolver.lookup
+
+        def lookup_and_add_job(resolver, *args):
+            if len(jobs) == 1:
+                # A much smaller job arrives once the first is under way
+                jobs.append(self.create_job())
+            return lookup(resolver, *args)
+
+        with patch('bulk_lookup.management.commands.process_bulk_lookups.time.monotonic',
+                   side_effect=itertools.count(0, 1000)), \
+                patch.object(PostcodeResolver, 'lookup', lookup_and_add_job):
+            call_command('process_bulk_lookups', chunk_size=2, time_slice=1)
+        # Both finished, the first having been paused to let the second go first
+        first, second = jobs
+        for b in jobs:
+            self.assertLookupOutput(self.read_output(b), area)
+            self.assertEqual((b.error_count, b.checkpoint_row, b.stats['outcome']), (0, 0, 'finished'))
+        self.assertEqual(second.stats['stages']['read']['rows'], 5)
+        self.assertLess(first.stats['stages']['read']['rows'], 5)
+
+    def test_waiting_ahead(self):
+        running = models.BulkLookup.objects.create(
+            charge_id='r_test', profile={'num_rows': 1000}, started=timezone.now())
+        waiting = models.BulkLookup.objects.create(charge_id='r_test', profile={'num_rows': 500})
+        self.assertTrue(models.BulkLookup.objects.waiting_ahead(running, 0))
+        # Not once the running job has fewer rows left than the waiting one
+        self.assertFalse(models.BulkLookup.objects.waiting_ahead(running, 600))
+        # Nor if the waiting one failed earlier, and so won't be claimed
+        self.assertFalse(models.BulkLookup.objects.waiting_ahead(running, 0, exclude=[waiting.pk]))
+
+    def test_stop(self):
+        self.create_areas()
+        b, waiting = self.create_job(), self.create_job()
+        command = process_bulk_lookups.Command(stdout=StringIO())
+        lookup = PostcodeResolver.lookup
+
+        def lookup_then_stop(resolver, *args):
+            # As if SIGTERM arrived part way through the first chunk
+            command.running = False
+            return lookup(resolver, *args)
+
+        with patch.object(PostcodeResolver, 'lookup', lookup_then_stop):
+            call_command(command, chunk_size=2)
+        # The job was checkpointed after that chunk and put back, and no other was started
+        b.refresh_from_db()
+        self.assertEqual((b.started, b.finished, b.checkpoint_row), (None, None, 2))
+        self.assertEqual((b.error_count, b.stats['outcome']), (0, 'paused'))
+        waiting.refresh_from_db()
+        self.assertIsNone(waiting.started)
+
+    @override_settings(BULK_LOOKUP_FREE_WEIGHT=1, BULK_LOOKUP_PAID_WEIGHT=10, BULK_LOOKUP_AGE_ROWS=100)
+    def test_claim_order(self):
+        def job(charge_id, rows, minutes=0, checkpoint_row=0):
+            b = models.BulkLookup.objects.create(
+                charge_id=charge_id, profile={'num_rows': rows}, checkpoint_row=checkpoint_row)
+            models.BulkLookup.objects.filter(pk=b.pk).update(created=timezone.now() - timedelta(minutes=minutes))
+            return b.pk
+
+        # Big jobs catch up as they wait, and count only what's left after a checkpoint
+        big = job('r_test', 10000, minutes=10)
+        small = job('r_test', 500)
+        paid = job('cs_test', 2000)
+        resumed = job('r_test', 10000, checkpoint_row=9900)
+        job('', 1)
+        claimed = [models.BulkLookup.objects.claim_next().pk for i in range(3)]
+        self.assertEqual(claimed, [resumed, paid, small])
+        self.assertIsNone(models.BulkLookup.objects.claim_next(exclude=[big]))
+        self.assertEqual(models.BulkLookup.objects.claim_next().pk, big)
+        self.assertEqual(models.BulkLookup.objects.filter(started__isnull=False).count(), 4)
+
+    def test_expire(self):
+        old, kept, recent = self.create_job(), self.create_job(), self.create_job()
+        for b, days in ((old, 12), (kept, 8), (recent, 2)):
+            b.output_file.save('test-mapit.csv', ContentFile('ID,Postcode\n1,SW1A 1AA\n'), save=False)
+            b.finished = timezone.now() - timedelta(days=days)
+            b.save()
+        old_files = (old.original_file.path, old.output_file.path)
+        kept_output, recent_output = kept.output_file.path, recent.output_file.path
+        call_command('expire_bulk_lookups', days=10, compress_after=7)
+
+        old.refresh_from_db()
+        self.assertEqual((old.original_file.name, old.output_file.name), ('', ''))
+        for path in old_files:
+            self.assertFalse(os.path.exists(path))
+            self.assertFalse(os.path.exists(os.path.dirname(path)))
+        # Kept beyond the seven days the email promised, so compressed
+        kept.refresh_from_db()
+        self.assertTrue(kept.original_file)
+        self.assertEqual(kept.output_file.path, kept_output + '.gz')
+        self.assertFalse(os.path.exists(kept_output))
+        with gzip.open(kept.output_file.path, 'rt') as f:
+            self.assertEqual(f.read(), 'ID,Postcode\n1,SW1A 1AA\n')
+        recent.refresh_from_db()
+        self.assertEqual(recent.output_file.path, recent_output)
+
+    def test_expire_compress_options(self):
+        # Compressing needs files to be kept for longer than the link is promised for
+        for options in ({'compress_after': 6, 'days': 10}, {'compress_after': 7}, {'compress_after': 10, 'days': 10}):
+            with self.assertRaises(CommandError):
+                call_command('expire_bulk_lookups', **options)
+
+    def test_expire_unfinished(self):
+        unpaid, given_up, retrying = self.create_job(), self.create_job(), self.create_job()
+        long_ago = timezone.now() - timedelta(days=8)
+        models.BulkLookup.objects.filter(pk=unpaid.pk).update(charge_id='', created=long_ago)
+        given_up.checkpoint_file.save('1-checkpoint.csv', ContentFile('ID,Postcode\n'), save=False)
+        given_up.checkpoint_row = 1
+        given_up.error_count = 3
+        given_up.last_error = long_ago
+        given_up.save()
+        models.BulkLookup.objects.filter(pk=retrying.pk).update(error_count=1, last_error=long_ago)
+        checkpoint = given_up.checkpoint_file.path
+        call_command('expire_bulk_lookups')
+
+        for b in (unpaid, given_up):
+            b.refresh_from_db()
+            self.assertEqual((b.original_file.name, b.checkpoint_file.name, b.checkpoint_row), ('', '', 0))
+        self.assertFalse(os.path.exists(checkpoint))
+        retrying.refresh_from_db()
+        self.assertTrue(retrying.original_file)
+        with self.assertRaises(CommandError):
+            call_command('expire_bulk_lookups', compress_after=1)
+
+    def test_gzip_output(self):
+        area = self.create_areas()
+        b = self.create_job()
+        b.output_format = 'csv.gz'
+        b.save()
+        # Checkpoints along the way leave the output in several gzip members,
+        # and the second is appended to the file the first uploaded
+        call_command('process_bulk_lookups', chunk_size=1, checkpoint_interval=2)
+        b.refresh_from_db()
+        self.assertTrue(b.output_file.name.endswith('test-mapit.csv.gz'))
+        with gzip.open(b.output_file.path, 'rb') as f:
+            self.assertLookupOutputBytes(f.read(), area)
+
+    def test_resolver_queries(self):
+        area = self.create_areas()
+        resolver = PostcodeResolver(area.generation_low_id)
+        # Precomputed areas, spatial query, then every area of the generation
+        with self.assertNumQueries(3):
+            self.assertEqual(resolver.resolve({'SW1A1AA'}), {'SW1A1AA': (
+                LookupArea(area.id, 'Cities of London and Westminster', 'WMC', 'E14000639'),)})
+        # The areas are already known
+        with self.assertNumQueries(2):
+            resolver.resolve({'SW1A0AA'})
+
+    def test_worker_chunk(self):
+        area = self.create_areas()
+        o = models.OutputOption.objects.create(name='Constituency', mapit_area_type='WMC')
+        workers.resolver = PostcodeResolver(area.generation_low_id)
+        rows = [['1', 'SW1A 1AA'], ['2', 'EH11BB', 'extra']]
+        self.assertEqual(workers.lookup_chunk(rows, 1, 2, OutputProjector([o])), (
+            '1,SW1A 1AA,Cities of London and Westminster,E14000639,%d\r\n'
+            '2,EH11BB,,,\r\n' % area.id))
+
+    def test_profile(self):
+        b = models.BulkLookup(postcode_field='Postcode')
+        b.original_file.save("test.csv", ContentFile("ID,Postcode\n1,SW1A1AA,,\n2,Bad\n\n3,eh1 1bb"), save=False)
+        self.assertEqual(b.make_profile(), {
+            'fieldnames': ['ID', 'Postcode'],
+            'example_rows': [['1', 'SW1A1AA'], ['2', 'Bad'], ['3', 'eh1 1bb']],
+            'num_rows': 3,
+            'valid_postcodes': [0, 2],
+            'bad_rows': [[1, 2, 3], [2]],
+        })
+
+    def test_admin_profile(self):
+        # Jobs added in the admin are profiled, so they aren't claimed as if they had no rows
+        b = models.BulkLookup(postcode_field='Postcode', charge_id='r_test')
+        b.original_file.save("test.csv", ContentFile("ID,Postcode\n1,SW1A1AA\n2,EH11BB"), save=False)
+        admin.site._registry[models.BulkLookup].save_model(None, b, None, False)
+        b.refresh_from_db()
+        self.assertEqual(b.profile['num_rows'], 2)
+
     def test_excel_ods_files(self):
         data = [
             {'Postcode': 'B2 4QA', 'ID': 1, 'Name': 'Alice'},
             {'Postcode': 'M60 7RA', 'ID': 2, 'Name': 'Amanda'},
             {'Postcode': 'EH1 1BB', 'ID': 3, 'Name': 'Annabel'},
         ]
-        for typ in ('csv', 'xlsx', 'ods'):
+        for typ in ('csv', 'xls', 'xlsx', 'ods'):
             with open(os.path.dirname(__file__) + '/fixtures/test.' + typ, 'rb') as fp:
                 reader = csv.PyExcelReader(File(fp))
                 self.assertEqual(reader.fieldnames, ['ID', 'Name', 'Postcode'])
                 self.assertEqual(list(reader), data)
 
+    def test_streaming_xlsx(self):
+        with open(os.path.dirname(__file__) + '/fixtures/test.xlsx', 'rb') as fp:
+            reader = csv.XLSXReader(File(fp))
+            self.assertEqual(reader.fieldnames, ['ID', 'Name', 'Postcode'])
+            self.assertEqual(list(reader.rows()), [
+                [1, 'Alice', 'B2 4QA'], [2, 'Amanda', 'M60 7RA'], [3, 'Annabel', 'EH1 1BB']])
+
     def test_null_byte(self):
         csv_file = StringIO('ID,Postcode\n1,SW1A1AA\n2,EH11BB\0')
         csv_file.content_type = 'text/csv'
@@ -101,3 +472,40 @@ class BulkLookupViewTest(TestCase):
             'csv-original_file': csv_file,
         })
         self.assertContains(response, u'Penzance')
+
+
+class OutputProjectorTest(SimpleTestCase):
+    def test_project(self):
+        projector = OutputProjector([
+            models.OutputOption(name='Constituency', mapit_area_type='WMC'),
+            models.OutputOption(name='County', mapit_area_type='CTY'),
+        ])
+        self.assertEqual(projector.field_names[3:], ['County - Name', 'County - GSS Code', 'County - MapIt ID'])
+        self.assertEqual(projector.project((
+            LookupArea(1, 'Westminster', 'WMC', 'E14000639'),
+            LookupArea(2, 'Other', 'WMC', 'E14000001'),
+            LookupArea(3, 'London', 'LBO', 'E09000033'),
+        )), ['Westminster', 'E14000639', 1, '', '', ''])
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(KeyError, lambda: cache['b'])
+        self.assertEqual(cache['c'], 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+class CleanPostcodesTest(SimpleTestCase):
+    def test_clean_postcodes(self):
+        self.assertEqual(clean_postcodes(['sw1a 1aa', 'EH1-1BB', None, 3, 'Not a postcode', '']), (
+            ['SW1A1AA', 'EH11BB', 'NONE', '3', 'NOTAPOSTCODE', ''],
+            [True, True, False, False, False, False]))
+
+    def test_separator_in_value(self):
+        self.assertEqual(clean_postcodes(['SW1A\n1AA', 'EH1 1BB']), (['SW1A1AA', 'EH11BB'], [True, True]))
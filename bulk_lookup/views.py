@@ -50,6 +50,12 @@ class WizardView(NeverCacheMixin, StripeObjectMixin, SessionWizardView):
             self.storage.current_step = self.steps.first
             return self.render(self.get_form())
 
+    def process_step(self, form):
+        # Read the uploaded file just the once, and remember what we need from it
+        if self.steps.current == 'csv':
+            self.storage.extra_data = {'profile': BulkLookup(**form.cleaned_data).make_profile()}
+        return super(WizardView, self).process_step(form)
+
     def get_template_names(self):
         return [self.TEMPLATES[self.steps.current]]
 
@@ -58,7 +64,7 @@ class WizardView(NeverCacheMixin, StripeObjectMixin, SessionWizardView):
         dat = self.get_cleaned_data_for_step('csv')
         if not dat:
             raise WizardError
-        return BulkLookup(**dat)
+        return BulkLookup(profile=self.storage.extra_data.get('profile'), **dat)
 
     def get_form_kwargs(self, step):
         kwargs = super(WizardView, self).get_form_kwargs(step)
@@ -125,6 +131,7 @@ class WizardView(NeverCacheMixin, StripeObjectMixin, SessionWizardView):
 
         output_options = data.pop('output_options')
         data.pop('num_rows')
+        data['profile'] = self.storage.extra_data.get('profile')
         bulk_lookup = BulkLookup.objects.create(**data)
         bulk_lookup.output_options.add(*output_options)
 
@@ -132,6 +139,7 @@ class WizardView(NeverCacheMixin, StripeObjectMixin, SessionWizardView):
             context = payment_view_context(bulk_lookup)
             return render(self.request, 'bulk_lookup/payment.html', context)
         else:
+            bulk_lookup.notify_ready()
             return redirect('finished', pk=bulk_lookup.id, token=bulk_lookup.charge_id)
 
 
@@ -189,5 +197,6 @@ class FinishedView(NeverCacheMixin, DetailView):
             if checkout_session.payment_status != 'unpaid' and not obj.charge_id:
                 obj.charge_id = self.kwargs['token']
                 obj.save()
+                obj.notify_ready()
 
         return obj
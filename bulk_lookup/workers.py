@@ -0,0 +1,25 @@
+"""Worker processes for process_bulk_lookups --workers. These are spawned
+fresh, so Django has to be set up (with the worker's own database connection)
+before anything that uses models can be imported."""
+import io
+
+import django
+
+resolver = None
+
+
+def init_worker(generation, cache_size):
+    global resolver
+    django.setup()
+    from .resolver import PostcodeResolver
+    resolver = PostcodeResolver(generation, cache_size=cache_size)
+
+
+def lookup_chunk(rows, postcode_index, width, projector):
+    """Looks up a chunk of rows, returning them as CSV without a header."""
+    from .csv import CSVWriter
+    out = io.StringIO()
+    writer = CSVWriter(out)
+    writer.writerows(resolver.lookup(rows, postcode_index, width, projector))
+    writer.flush()
+    return out.getvalue()
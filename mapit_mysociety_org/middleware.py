@@ -1,10 +1,21 @@
-from functools import partial
+import re
+
 from django.utils.encoding import force_bytes
 from .multidb import use_primary
-from api_keys.models import APIKey
+from api_keys.models import user_keys
 
 READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'TRACE'])
 
+# Where add_api_key puts the API key into pages. The key takes the place of
+# {} in what each match is replaced with.
+API_KEY_REPLACEMENTS = {
+    b'simplify_tolerance=0.0001': b'simplify_tolerance=0.0001&api_key={}',
+    b'data-key=""': b'data-key="{}"',
+    b'.geojson"': b'.geojson?api_key={}"',
+    b'.kml"': b'.kml?api_key={}"',
+    b'.wkt"': b'.wkt?api_key={}"',
+}
+
 
 def force_primary_middleware(get_response):
     """On a non-read request (e.g. POST), always use the primary database, and
@@ -25,32 +36,63 @@ def force_primary_middleware(get_response):
     return middleware
 
 
+class Rewriter(object):
+    """Replaces any of a set of byte strings with others, in one pass over
+    some content, or over a stream of chunks of content, carrying over the
+    end of each chunk in case a match runs into the next one."""
+
+    def __init__(self, replacements):
+        self.replacements = replacements
+        self.pattern = re.compile(b'|'.join(re.escape(find) for find in replacements))
+        self.max_length = max(len(find) for find in replacements)
+
+    def replace(self, match):
+        return self.replacements[match.group()]
+
+    def rewrite(self, content):
+        return self.pattern.sub(self.replace, content)
+
+    def rewrite_stream(self, chunks):
+        carry = b''
+        for chunk in chunks:
+            content = carry + force_bytes(chunk)
+            # A match starting before here must be complete; one after might not be
+            limit = len(content) - self.max_length + 1
+            output = []
+            position = 0
+            for match in self.pattern.finditer(content):
+                if match.start() >= limit:
+                    break
+                output.append(content[position:match.start()])
+                output.append(self.replace(match))
+                position = match.end()
+            carry_from = max(position, limit)
+            output.append(content[position:carry_from])
+            carry = content[carry_from:]
+            yield b''.join(output)
+        yield self.rewrite(carry)
+
+
 def add_api_key(get_response):
     """If logged in, we want to include the API key in any
-    client-side JSON calls (e.g. to plot area on map)."""
-
-    def alter_content(api_key, content):
-        key = force_bytes(api_key)
-        content = content.replace(b'simplify_tolerance=0.0001', b'simplify_tolerance=0.0001&api_key=' + key)
-        content = content.replace(b'data-key=""', b'data-key="' + key + b'"')
-        content = content.replace(b'.geojson"', b'.geojson?api_key=' + key + b'"')
-        content = content.replace(b'.kml"', b'.kml?api_key=' + key + b'"')
-        content = content.replace(b'.wkt"', b'.wkt?api_key=' + key + b'"')
-        return content
+    client-side JSON calls (e.g. to plot area on map).
+    Only HTML pages are changed."""
 
     def middleware(request):
         api_key = None
         if request.user.is_authenticated:
-            api_key = APIKey.objects.filter(user=request.user).first()
+            api_key = user_keys.get(request.user.id)
 
         response = get_response(request)
 
-        if api_key:
-            wrap_content = partial(alter_content, api_key.key)
+        if api_key and response.get('Content-Type', '').startswith('text/html'):
+            key = force_bytes(api_key)
+            rewriter = Rewriter({
+                find: replace.replace(b'{}', key) for find, replace in API_KEY_REPLACEMENTS.items()})
             if response.streaming:
-                response.streaming_content = map(wrap_content, response.streaming_content)
+                response.streaming_content = rewriter.rewrite_stream(response.streaming_content)
             else:
-                response.content = wrap_content(response.content)
+                response.content = rewriter.rewrite(response.content)
 
         return response
 
@@ -180,6 +180,28 @@ MAX_RETRIES = 3
 RETRY_INTERVAL = 0
 BULK_LOOKUP_AMOUNT = config.get('BULK_LOOKUP_AMOUNT')
 BULK_LOOKUP_PRICE_ID = config.get('BULK_LOOKUP_PRICE_ID')
+# How long to keep uploaded and output files after a job finishes; see expire_bulk_lookups
+BULK_LOOKUP_KEEP_DAYS = 7
+# Queued jobs are taken in order of rows left divided by weight, less AGE_ROWS
+# per minute waited; see CLAIM_SQL in bulk_lookup.models
+BULK_LOOKUP_FREE_WEIGHT = config.get('BULK_LOOKUP_FREE_WEIGHT', 1)
+BULK_LOOKUP_PAID_WEIGHT = config.get('BULK_LOOKUP_PAID_WEIGHT', 1)
+BULK_LOOKUP_AGE_ROWS = config.get('BULK_LOOKUP_AGE_ROWS', 10000)
+
+# process_bulk_lookups logs how long each stage of each job took, as JSON, at
+# INFO level. Only warnings are shown unless BULK_LOOKUP_LOG_LEVEL says otherwise,
+# so as not to send mail for every job when run from cron
+BULK_LOOKUP_LOG_LEVEL = config.get('BULK_LOOKUP_LOG_LEVEL', 'WARNING')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'bulk_lookup': {'handlers': ['console'], 'level': 'WARNING' if 'test' in sys.argv else BULK_LOOKUP_LOG_LEVEL},
+    },
+}
 
 # API subscriptions
 if 'test' in sys.argv:
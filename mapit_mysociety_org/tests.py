@@ -9,6 +9,7 @@ from django.contrib.sites.models import Site
 from django.core import mail
 from django.core.management import call_command
 from django.urls import reverse
+from django.test import SimpleTestCase
 from django.test.utils import override_settings
 from stripe import convert_to_stripe_object
 import stripe
@@ -17,6 +18,8 @@ from subscriptions.models import Subscription
 from subscriptions.tests import PatchedStripeMixin
 from api_keys.tests import PatchedRedisTestCase
 
+from .middleware import Rewriter
+
 
 class SignupViewTest(PatchedStripeMixin, PatchedRedisTestCase):
     @patch('socket.getfqdn')
@@ -101,3 +104,20 @@ class ManagementTest(PatchedStripeMixin, PatchedRedisTestCase):
     def test_create_default_site_first_time(self):
         Site.objects.all().delete()
         call_command('create_default_site', stdout=StringIO(), stderr=StringIO())
+
+
+class RewriterTest(SimpleTestCase):
+    def setUp(self):
+        self.rewriter = Rewriter({b'.kml"': b'.kml?api_key=KEY"', b'data-key=""': b'data-key="KEY"'})
+
+    def test_rewrite(self):
+        self.assertEqual(
+            self.rewriter.rewrite(b'<a href="/area/1.kml">KML</a><div data-key=""></div>'),
+            b'<a href="/area/1.kml?api_key=KEY">KML</a><div data-key="KEY"></div>')
+
+    def test_rewrite_stream(self):
+        # Matches split across chunks are still found
+        chunks = [b'<a href="/area/1.k', b'ml', b'">KML</a><div data-', b'key="', b'"></div>']
+        self.assertEqual(
+            b''.join(self.rewriter.rewrite_stream(iter(chunks))),
+            b'<a href="/area/1.kml?api_key=KEY">KML</a><div data-key="KEY"></div>')
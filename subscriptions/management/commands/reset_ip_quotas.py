@@ -1,3 +1,8 @@
+import re
+import time
+
+from redis.exceptions import ResponseError
+
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
@@ -7,20 +12,59 @@ from api_keys.utils import redis_connection
 class Command(BaseCommand):
     help = """Reset IP address daily usage blocks."""
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of keys to remove in each round trip to Redis (default 1000)')
+        parser.add_argument(
+            '--scan-count', type=int, default=1000,
+            help='Number of keys for Redis to look at in each SCAN call (default 1000)')
+
     def handle(self, **options):
+        verbosity = options['verbosity']
+        batch_size = options['batch_size']
+        api_name = settings.REDIS_API_NAME
+        quota_key = re.compile(r'^user:(.+):quota:%s:(count|blocked)$' % re.escape(api_name))
+
         r = redis_connection()
-        # Clear IPv4 and IPv6 separately due to issues with our test mock handling a glob in the match.
-        # IPv4
-        for key in r.scan_iter(match='user:*.*:quota:%s:count' % settings.REDIS_API_NAME, count=100):
-            r.delete(key)
-            if options['verbosity'] > 1:
+        self.unlink = True
+        counts = {'IPv4': 0, 'IPv6': 0}
+        batch = []
+        start = time.monotonic()
+        # One pass over every quota key. Anonymous users are identified by IP
+        # address, logged in users by a numeric ID, which are left alone.
+        for key in r.scan_iter(match='user:*:quota:%s:*' % api_name, count=options['scan_count']):
+            match = quota_key.match(key.decode('utf-8', 'replace'))
+            if not match:
+                continue
+            identity, name = match.groups()
+            if ':' in identity:
+                counts['IPv6'] += 1
+            elif '.' in identity:
+                counts['IPv4'] += 1
+            else:
+                continue
+            if verbosity > 1 and name == 'count':
                 self.stdout.write("Removed IP %s" % key)
-        for key in r.scan_iter(match='user:*.*:quota:%s:blocked' % settings.REDIS_API_NAME, count=100):
-            r.delete(key)
-        # IPv6
-        for key in r.scan_iter(match='user:*:*:quota:%s:count' % settings.REDIS_API_NAME, count=100):
-            r.delete(key)
-            if options['verbosity'] > 1:
-                self.stdout.write("Removed IP %s" % key)
-        for key in r.scan_iter(match='user:*:*:quota:%s:blocked' % settings.REDIS_API_NAME, count=100):
-            r.delete(key)
+            batch.append(key)
+            if len(batch) >= batch_size:
+                self.remove(r, batch)
+                batch = []
+        if batch:
+            self.remove(r, batch)
+
+        if verbosity > 0:
+            seconds = time.monotonic() - start
+            total = counts['IPv4'] + counts['IPv6']
+            self.stdout.write("Removed %d keys (%d IPv4, %d IPv6) in %.1f seconds, %d keys per second" % (
+                total, counts['IPv4'], counts['IPv6'], seconds, total / seconds if seconds else total))
+
+    def remove(self, r, keys):
+        # UNLINK frees the memory in the background, but isn't in Redis before 4.0
+        if self.unlink:
+            try:
+                r.unlink(*keys)
+                return
+            except ResponseError:
+                self.unlink = False
+        r.delete(*keys)
@@ -2,7 +2,23 @@ from django.conf import settings
 from django.db import models
 from django.dispatch import receiver
 
-from api_keys.utils import redis_connection
+from api_keys.utils import redis_connection, redis_pipeline
+
+# How many previous months' usage to keep for each subscription
+QUOTA_HISTORY_LENGTH = 24
+
+# Starts a new month's quota: moves the count (KEYS[1]) to the end of the
+# history (KEYS[3]), keeping only the last ARGV[1] months, and unblocks
+# (KEYS[2]). Run as a script so that nothing can happen in between.
+RESET_QUOTA_SCRIPT = '''
+local count = redis.call('GETSET', KEYS[1], 0)
+if count then
+    redis.call('RPUSH', KEYS[3], count)
+    redis.call('LTRIM', KEYS[3], -tonumber(ARGV[1]), -1)
+end
+redis.call('DEL', KEYS[2])
+return count
+'''
 
 
 def ensure_int(s):
@@ -41,30 +57,31 @@ class Subscription(models.Model):
 
     def redis_update_max(self, price):
         max = int(price.metadata['calls'])
-        r = redis_connection()
-        r.set(self.redis_key_max, max)
-        r.delete(self.redis_key_blocked)
+        with redis_pipeline(transaction=True) as pipe:
+            pipe.set(self.redis_key_max, max)
+            pipe.delete(self.redis_key_blocked)
+            pipe.execute()
 
     def redis_reset_quota(self):
-        r = redis_connection()
-        count = r.getset(self.redis_key_count, 0)
-        if count is not None:
-            r.rpush(self.redis_key_history, count)
-        r.delete(self.redis_key_blocked)
+        reset_quota = redis_connection().register_script(RESET_QUOTA_SCRIPT)
+        reset_quota(
+            keys=[self.redis_key_count, self.redis_key_blocked, self.redis_key_history],
+            args=[QUOTA_HISTORY_LENGTH])
 
     def delete_from_redis(self):
         r = redis_connection()
-        r.delete(self.redis_key_max)
-        r.delete(self.redis_key_count)
-        r.delete(self.redis_key_blocked)
+        r.delete(self.redis_key_max, self.redis_key_count, self.redis_key_blocked)
 
     def redis_status(self):
-        r = redis_connection()
+        with redis_pipeline() as pipe:
+            pipe.mget(self.redis_key_count, self.redis_key_blocked, self.redis_key_max)
+            pipe.lrange(self.redis_key_history, -QUOTA_HISTORY_LENGTH, -1)
+            (count, blocked, quota), history = pipe.execute()
         return {
-            'count': ensure_int(r.get(self.redis_key_count)),
-            'blocked': ensure_int(r.get(self.redis_key_blocked)),
-            'quota': ensure_int(r.get(self.redis_key_max)),
-            'history': r.lrange(self.redis_key_history, 0, -1),
+            'count': ensure_int(count),
+            'blocked': ensure_int(blocked),
+            'quota': ensure_int(quota),
+            'history': history,
         }
 
 
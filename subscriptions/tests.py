@@ -11,6 +11,7 @@ from django.core.management import call_command
 from django.urls import reverse
 from django.test import TestCase
 from django.test.utils import override_settings
+from redis.exceptions import ResponseError
 import stripe
 from stripe import convert_to_stripe_object
 
@@ -154,6 +155,16 @@ class SubscriptionTest(UserTestCase):
         sub.delete()
         self.assertEqual(sub.redis_status(), {'count': 0, 'history': [b'1234'], 'quota': 0, 'blocked': 0})
 
+    @patch('subscriptions.models.QUOTA_HISTORY_LENGTH', 2)
+    def test_redis_history_capped(self):
+        sub = Subscription.objects.create(user=self.user, stripe_id='ID')
+        r = redis_connection()
+        for count in (1, 2, 3):
+            r.set(sub.redis_key_count, count)
+            sub.redis_reset_quota()
+        self.assertEqual(r.lrange(sub.redis_key_history, 0, -1), [b'2', b'3'])
+        self.assertEqual(sub.redis_status()['history'], [b'2', b'3'])
+
 
 class SubsFormTest(TestCase):
     def test_add_plan(self):
@@ -935,5 +946,27 @@ class ManagementTest(PatchedRedisTestCase):
         self.assertIsNone(r.get('user:fc00:1::1:quota:test_api:blocked'))
 
     def test_reset_ip_quotas(self):
-        self._test_reset_ip_quotas()
-        self._test_reset_ip_quotas(verbosity=2)
+        # The mock Redis has no UNLINK, so stand in DEL for it
+        r = redis_connection()
+        with patch.object(r, 'unlink', create=True, side_effect=r.delete) as unlink:
+            self._test_reset_ip_quotas()
+            self._test_reset_ip_quotas(verbosity=2)
+            self._test_reset_ip_quotas(batch_size=1)
+        self.assertTrue(unlink.called)
+
+    def test_reset_ip_quotas_without_unlink(self):
+        # As with a Redis server before 4.0
+        r = redis_connection()
+        with patch.object(r, 'unlink', create=True, side_effect=ResponseError('unknown command')):
+            self._test_reset_ip_quotas(batch_size=1)
+
+    def test_reset_ip_quotas_keeps_users(self):
+        r = redis_connection()
+        r.set('user:12:quota:test_api:count', 42)
+        r.set('user:127.0.0.2:quota:test_api:count', 42)
+        stdout = StringIO()
+        with patch.object(r, 'unlink', create=True, side_effect=r.delete):
+            call_command('reset_ip_quotas', stdout=stdout, stderr=StringIO())
+        self.assertEqual(r.get('user:12:quota:test_api:count'), b'42')
+        self.assertIsNone(r.get('user:127.0.0.2:quota:test_api:count'))
+        self.assertIn('Removed 1 keys (1 IPv4, 0 IPv6)', stdout.getvalue())
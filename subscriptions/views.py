@@ -485,5 +485,6 @@ def stripe_hook(request):
             if not bulk_lookup.charge_id:
                 bulk_lookup.charge_id = obj.id
                 bulk_lookup.save()
+                bulk_lookup.notify_ready()
 
     return HttpResponse(status=200)